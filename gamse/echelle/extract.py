@@ -164,7 +164,8 @@ def extract_aperset(data, mask, apertureset, lower_limit=5, upper_limit=5):
     bad_mask = (mask&2 > 0)
     gap_mask = (mask&1 > 0)
 
-    yy, xx = np.mgrid[:h:,:w:]
+    # broadcastable row and column indices instead of full 2-D grids
+    yy, xx = np.ix_(np.arange(h), np.arange(w))
     spectra1d = {}
     for aper, aper_loc in sorted(apertureset.items()):
         domain = aper_loc.position.domain
@@ -179,8 +180,8 @@ def extract_aperset(data, mask, apertureset, lower_limit=5, upper_limit=5):
         upper_line = np.minimum(upper_line, h-1-0.5)
         lower_ints = np.int32(np.round(lower_line))
         upper_ints = np.int32(np.round(upper_line))
-        m1 = yy[:,d1:d2] > lower_ints
-        m2 = yy[:,d1:d2] < upper_ints
+        m1 = yy > lower_ints
+        m2 = yy < upper_ints
         newmask = np.zeros_like(data, dtype=np.bool)
         newmask[:,d1:d2] = m1*m2
         newmask = np.float32(newmask)
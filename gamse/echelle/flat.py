@@ -59,7 +59,11 @@ def mosaic_flat_interact(filename_lst, outfile, mosaic_file, reg_file,
     nflat = len(filename_lst)
 
     for ifile, filename in enumerate(filename_lst):
-        data, head = fits.getdata(filename, header=True)
+        # open the image with memory mapping, so that only the cross-section
+        # is read from the disk
+        hdu_lst = fits.open(filename, memmap=True)
+        head = hdu_lst[0].header
+        data = hdu_lst[0].data
 
         if ifile == 0:
             shape = data.shape
@@ -80,21 +84,40 @@ def mosaic_flat_interact(filename_lst, outfile, mosaic_file, reg_file,
             
         if disp_axis == 0:
             # dispersion along Y axis
-            xsection = data[n_disp//2,:]
+            xsection = np.array(data[n_disp//2,:])
         elif disp_axis == 1:
             # dispersion along X axis
-            xsection = data[:,n_disp//2]
+            xsection = np.array(data[:,n_disp//2])
+
+        hdu_lst.close()
 
-        data_lst[filename] = data
         head_lst[filename] = head
         xsection_lst[filename] = xsection
 
+    def get_data(filename):
+        """Load the full image only when it is needed. At most two images are
+        kept in memory.
+        """
+        if filename in data_lst:
+            # move it to the end as the most recently used one
+            data_lst[filename] = data_lst.pop(filename)
+        else:
+            if len(data_lst) >= 2:
+                # remove the least recently used image
+                data_lst.pop(next(iter(data_lst)))
+            data_lst[filename] = fits.getdata(filename)
+        return data_lst[filename]
+
     # plot
     fig = plt.figure(figsize=(15,10), dpi=150, tight_layout=True)
 
     # initialize the parameters used in the mosaic boundaries
     # suppose n boundaries are identified by hand. there are n+1 areas.
 
+    # normalized pixel coordinates along the dispersion direction, used to
+    # evaluate the boundary polynomials
+    fig.norm_y = np.arange(n_disp, dtype=np.float32)/n_disp
+
     fig.bound_lst = np.zeros((1,n_disp),dtype=np.int32)
     # fig.bound_lst is a numpy array with n+1 x yrows
     # [
@@ -111,7 +134,10 @@ def mosaic_flat_interact(filename_lst, outfile, mosaic_file, reg_file,
     # direction. The first element is always 0, and the last element is always
     # n_disp (number of pixels along the dispersion direction).
 
-    fig.select_lst = [None]
+    fig.select_area = np.zeros((nflat, 1), dtype=bool)
+    # fig.select_area is a boolean array with nflat x (n+1) elements.
+    # fig.select_area[i,j] is True if the j-th area is taken from the i-th
+    # flat image.
 
     ax_lst = {}
     for i in range(nflat):
@@ -145,8 +171,7 @@ def mosaic_flat_interact(filename_lst, outfile, mosaic_file, reg_file,
                         xto = n_xdisp
                     else:
                         xto = fig.nodes[j+1]
-                    select = fig.select_lst[j]
-                    if select is not None and select==filename:
+                    if fig.select_area[i,j]:
                         ax.plot(np.arange(xfrom,xto), xsection[xfrom:xto],
                                 color=color, ls='-')
             ax.set_xlim(0, n_xdisp-1)
@@ -174,8 +199,7 @@ def mosaic_flat_interact(filename_lst, outfile, mosaic_file, reg_file,
                         xto = n_xdisp
                     else:
                         xto = fig.nodes[j+1]
-                    select = fig.select_lst[j]
-                    if select is not None and select==filename:
+                    if fig.select_area[i,j]:
                         xsection = xsection_lst[filename]
                         ax.plot(np.arange(xfrom,xto),xsection[xfrom:xto],
                                 color='k',ls='-')
@@ -191,10 +215,11 @@ def mosaic_flat_interact(filename_lst, outfile, mosaic_file, reg_file,
             i = np.searchsorted(fig.nodes, event.xdata) - 1
 
             # select and deselect
-            if fig.select_lst[i] is None:
-                fig.select_lst[i] = ax.filename
+            if not fig.select_area[:,i].any():
+                iflat = filename_lst.index(ax.filename)
+                fig.select_area[iflat,i] = True
             else:
-                fig.select_lst[i] = None
+                fig.select_area[:,i] = False
 
             replot()
 
@@ -205,7 +230,7 @@ def mosaic_flat_interact(filename_lst, outfile, mosaic_file, reg_file,
         if ax is not None and ax.filename is not None:
             if event.key == 'a':
                 # when press 'a', add boundary
-                data = data_lst[ax.filename]
+                data = get_data(ax.filename)
 
                 coeff = detect_gap(np.transpose(data),
                                    event.xdata,
@@ -213,8 +238,8 @@ def mosaic_flat_interact(filename_lst, outfile, mosaic_file, reg_file,
                                    ccf_llimit=30,
                                    )
                 # now calculate the y-pixels of this boundary line
-                norm_y = np.arange(n_disp, dtype=np.float32)/n_disp
-                bound = np.int32(np.round(np.polyval(coeff, norm_y)*n_xdisp))
+                bound = _estrin_polyval(coeff, fig.norm_y)
+                bound = np.rint(bound*n_xdisp).astype(np.int32, copy=False)
                 # the node in the central column is bound[int(yrows/2.]]
                 # now find the index of this node in the fig.nodes
                 ii = np.searchsorted(fig.nodes, bound[n_disp//2])
@@ -227,20 +252,27 @@ def mosaic_flat_interact(filename_lst, outfile, mosaic_file, reg_file,
                 fig.nodes = fig.bound_lst[:,n_disp//2]
                 print(fig.nodes)
 
-                # re-initialize the selected areas
-                fig.select_lst = [None for v in fig.nodes]
+                # the new boundary splits the (ii-1)-th area. the new area
+                # is not selected
+                fig.select_area = np.insert(fig.select_area, ii, False, axis=1)
 
             elif event.key == 'd':
                 # when press 'd', delete a boundary
-                if len(fig.nodes)>0:
-                    for i,p in enumerate(fig.nodes):
-                        # find the closet boundary
-                        if i>0 and abs(p-event.xdata) < n_xdisp/100.:
+                if len(fig.nodes)>1:
+                    # find the closet boundary. fig.nodes is sorted and the
+                    # first element (0) is not a boundary
+                    ii = np.searchsorted(fig.nodes, event.xdata)
+                    cand_lst = [j for j in (ii-1, ii)
+                                if 0 < j < len(fig.nodes)]
+                    if len(cand_lst)>0:
+                        i = min(cand_lst,
+                                key=lambda j: abs(fig.nodes[j]-event.xdata))
+                        if abs(fig.nodes[i]-event.xdata) < n_xdisp/100.:
                             fig.bound_lst   = np.delete(fig.bound_lst,i,axis=0)
                             fig.boundcoeff_lst.pop(i-1)
                             fig.nodes       = fig.bound_lst[:,n_disp//2]
-                            fig.select_lst.pop(i)
-                            break
+                            fig.select_area = np.delete(fig.select_area, i,
+                                                        axis=1)
             else:
                 pass
             replot()
@@ -253,58 +285,71 @@ def mosaic_flat_interact(filename_lst, outfile, mosaic_file, reg_file,
     #_ = raw_input('Press [Enter] to continue ')
 
     # check final mosaic flat
-    if None in fig.select_lst:
+    if not fig.select_area.any(axis=0).all():
         logger.error('Mosaic flat is not completed')
         raise ValueError
 
     # calculate mosaic flat and its mask
-    flat = np.zeros((h,w))
+    # the flat is built in the orientation of the input images, so that
+    # neither the inputs nor the output need to be transposed.
+    # single precision is enough for the count rates of flat images, and it
+    # halves the memory of the output image
+    flat = np.zeros((h, w), dtype=np.float32)
     flat_mask = np.zeros_like(flat, dtype=np.int16)
+
+    # label every pixel with the number of area it belongs to. area i is
+    # between fig.bound_lst[i] and fig.bound_lst[i+1]
+    xdisp_coord = np.arange(n_xdisp, dtype=np.int32)
+    if disp_axis == 0:
+        # dispersion along Y axis. boundaries are functions of row
+        xdisp_coord = xdisp_coord.reshape((1,-1))
+        bound_shape = (-1,1)
+    elif disp_axis == 1:
+        # dispersion along X axis. boundaries are functions of column
+        xdisp_coord = xdisp_coord.reshape((-1,1))
+        bound_shape = (1,-1)
+    region_id = np.zeros((h, w), dtype=np.int32)
+    for bound in fig.bound_lst[1:]:
+        region_id += xdisp_coord >= bound.reshape(bound_shape)
+
+    # cache of the flat images and masks, in case one flat is selected in
+    # more than one area
+    flat_cache = {}
+
     for i in range(fig.nodes.size):
-        yfrom = fig.bound_lst[i]
-        if i == fig.nodes.size - 1:
-            yto = np.repeat(h,w)
-        else:
-            yto = fig.bound_lst[i+1]
-        #xfrom = xfrom.reshape((-1,1))
-        #xto   = xto.reshape((-1,1))
-        yfrom = yfrom.reshape((1,-1))
-        yto   = yto.reshape((1,-1))
-
-        filename = fig.select_lst[i]
-        y,x = np.mgrid[:h,:w]
-        m = (y >= yfrom)*(y < yto)
-        colorflat,head = fits.getdata(filename,header=True)
-        # now get the filename for mask
-        mask_filename = '%s%s.fits'%(filename[0:-5], mask_suffix)
-        # read data from mask file
-        mtable = fits.getdata(mask_filename)
-        colorflat_mask  = table_to_array(mtable, colorflat.shape)
-        # make sure the dispersion axis is y
-        if disp_axis == 0:
-            colorflat = np.transpose(colorflat)
-            colorflat_mask = np.transpose(colorflat_mask)
-        #flat += m*colorflat/head['EXPTIME']
-        flat += m*colorflat
-        flat_mask += m*colorflat_mask
+        filename = filename_lst[fig.select_area[:,i].argmax()]
+        if filename not in flat_cache:
+            colorflat,head = fits.getdata(filename,header=True)
+            # now get the filename for mask
+            mask_filename = '%s%s.fits'%(filename[0:-5], mask_suffix)
+            # read data from mask file
+            mtable = fits.getdata(mask_filename)
+            colorflat_mask  = table_to_array(mtable, colorflat.shape)
+            flat_cache[filename] = (colorflat, colorflat_mask)
+        colorflat, colorflat_mask = flat_cache[filename]
+
+        # areas do not overlap with each other. copy the pixels directly
+        m = region_id == i
+        flat[m] = colorflat[m]
+        flat_mask[m] = colorflat_mask[m]
     header = fits.Header()
     #header['EXPTIME'] = 1.0
-    if disp_axis == 0:
-        flat = np.transpose(flat)
-        flat_mask = np.transpose(flat_mask)
     fits.writeto(outfile, flat, header, overwrite=True)
     outfile_mask = '%s%s.fits'%(outfile[0:-5], mask_suffix)
     mtable = array_to_table(flat_mask)
     fits.writeto(outfile_mask, mtable, overwrite=True)
 
     # save boundary coefficients into an ascii file
-    outfile1 = open(mosaic_file,'w')
+    lines = []
     for coeff in fig.boundcoeff_lst:
         string = ' '.join(['%+12.10e'%v for v in coeff])
-        outfile1.write('boundary %s%s'%(string, os.linesep))
+        lines.append('boundary %s%s'%(string, os.linesep))
     # save the selected areas for each filename
-    for filename in fig.select_lst:
-        outfile1.write('select %s'%filename+os.linesep)
+    for i in range(fig.nodes.size):
+        filename = filename_lst[fig.select_area[:,i].argmax()]
+        lines.append('select %s'%filename+os.linesep)
+    outfile1 = open(mosaic_file,'w')
+    outfile1.writelines(lines)
     outfile1.close()
 
     # save boundaries data in a .reg file
@@ -344,8 +389,8 @@ def detect_gap(data, x0, ccf_ulimit=50, ccf_llimit=50, step=50, order=4):
     x1 = int(xpoint - ccf_ulimit)
     x2 = int(xpoint + ccf_llimit)
     data1 = data[row1,x1:x2]
-    xnode_lst = np.array([xpoint])
-    ynode_lst = np.array([row1])
+    xnode_lst = [xpoint]
+    ynode_lst = [row1]
     # search direction
     direction = +1
     while(True):
@@ -366,27 +411,18 @@ def detect_gap(data, x0, ccf_ulimit=50, ccf_llimit=50, step=50, order=4):
         except:
             row1 = row2
             continue
-        f = intp.InterpolatedUnivariateSpline(np.arange(data2.size),data2,k=3)
-        shift_lst = np.arange(-10, 10, dtype=np.float32)
-        corre_lst = []
-        n1 = math.sqrt((data1**2).sum())
-        # calculate cross-correlation function
-        for j in shift_lst:
-            data3 = f(np.arange(data2.size)+j)
-            corr = (data1*data3).sum()
-            n2 = math.sqrt((data3**2).sum())
-            corre_lst.append(corr/n2)
-        corre_lst = np.array(corre_lst)/n1
-        f2 = InterpolatedUnivariateSpline(shift_lst,-corre_lst,k=3)
-        # find the maximum value of cross correlation function
-        result = opt.minimize(f2, 0.0, method='BFGS')
-        shift = result.x
+        shift = _get_gap_shift(data1, data2, maxshift=10)
         xpoint += shift
         row1 = row2
         if -w/2 < xpoint < w*1.5:
-            ii = np.searchsorted(ynode_lst,row2)
-            ynode_lst = np.insert(ynode_lst,ii,row2)
-            xnode_lst = np.insert(xnode_lst,ii,xpoint)
+            ynode_lst.append(row2)
+            xnode_lst.append(xpoint)
+
+    # sort the nodes along the dispersion direction
+    ynode_lst = np.array(ynode_lst)
+    idx = np.argsort(ynode_lst, kind='stable')
+    ynode_lst = ynode_lst[idx]
+    xnode_lst = np.array(xnode_lst)[idx]
 
     # fit the trend with polynomial
     # normalize x and y axis
@@ -395,6 +431,74 @@ def detect_gap(data, x0, ccf_ulimit=50, ccf_llimit=50, step=50, order=4):
     coeff = np.polyfit(xfit,yfit,deg=order)
     return coeff
 
+def _get_gap_shift(data1, data2, maxshift=10):
+    """Find the shift of **data2** relative to **data1** by cross-correlation.
+
+    Args:
+        data1 (:class:`numpy.ndarray`): Reference 1-d data segment.
+        data2 (:class:`numpy.ndarray`): 1-d data segment with the same length
+            as **data1**.
+        maxshift (int): Maximum integer lag to search.
+
+    Returns:
+        float: Sub-pixel shift of **data2**.
+
+    """
+    # work in floats. the squares of integer data would overflow
+    data1 = np.asarray(data1, dtype=np.float64)
+    data2 = np.asarray(data2, dtype=np.float64)
+
+    # calculate cross-correlation function by FFT. the lag j is located at
+    # index j+n-1 of the full correlation
+    n = data2.size
+    corr = sg.fftconvolve(data2, data1[::-1], mode='full')
+    maxshift = min(maxshift, n-1)
+    lags = np.arange(-maxshift, maxshift+1)
+    # energy of data2 in the overlapping part for each lag, calculated from
+    # the cumulative sum of data2**2
+    csq = np.concatenate(([0.], np.cumsum(data2**2)))
+    norm = np.sqrt(csq[np.minimum(n, n+lags)] - csq[np.maximum(0, lags)])
+    ccf = corr[lags+n-1]/np.maximum(norm, 1e-30)
+
+    # find the maximum value of cross correlation function, and refine it
+    # with a parabola through the three points around the peak
+    k = ccf.argmax()
+    shift = float(k - maxshift)
+    if 0 < k < ccf.size-1:
+        c1, c2, c3 = ccf[k-1:k+2]
+        denom = c1 - 2*c2 + c3
+        if denom != 0:
+            shift += 0.5*(c1 - c3)/denom
+    return shift
+
+def _estrin_polyval(coeff, x):
+    """Evaluate a polynomial with the Estrin scheme.
+
+    Terms are combined pairwise with increasing powers of **x** (*x*, *x*\
+    :sup:`2`, *x*\ :sup:`4`, ...), so the multiplications of each level are
+    independent of each other, unlike the single dependency chain of the
+    Horner scheme used by :func:`numpy.polyval`.
+
+    Args:
+        coeff (:class:`numpy.ndarray`): Coefficients in decreasing powers, as
+            in :func:`numpy.polyval`. Extra dimensions of each coefficient
+            are broadcast against **x**.
+        x (:class:`numpy.ndarray`): Points where the polynomial is evaluated.
+
+    Returns:
+        :class:`numpy.ndarray`: Values of the polynomial.
+
+    """
+    # coefficients in increasing powers
+    c_lst = list(np.asarray(coeff)[::-1])
+    p = x
+    while len(c_lst) > 1:
+        if len(c_lst)%2 == 1:
+            c_lst.append(0.0)
+        c_lst = [c_lst[i] + c_lst[i+1]*p for i in range(0, len(c_lst), 2)]
+        p = p*p
+    return c_lst[0] + np.zeros_like(x)
+
 def load_mosaic(filename):
     """Read mosaic boundary information from an existing ASCII file.
 
@@ -419,21 +523,21 @@ def load_mosaic(filename):
         exit()
 
     infile = open(filename)
-    for row in infile:
-        row = row.strip()
-        if len(row)==0 or row[0] in '#%':
-            continue
-        g = row.split()
-        if g[0] == 'boundary':
-            coeff = [float(v) for v in g[1:]]
-            coeff_lst.append(coeff)
-        elif g[0] == 'select' and g[1] == 'file':
-            filename = g[2]
-            selects = [bool(int(v)) for v in g[3:]]
-            select_area[filename] = selects
-        else:
-            pass
+    row_lst = [row.strip() for row in infile]
     infile.close()
+    row_lst = [row for row in row_lst if len(row)>0 and row[0] not in '#%']
+
+    # parse the numbers of each row with a single call
+    for row in row_lst:
+        if row.startswith('boundary'):
+            coeff_lst.append(np.fromstring(row[8:], sep=' '))
+
+    for row in row_lst:
+        g = row.split(None, 3)
+        if g[0] == 'select' and len(g) > 2 and g[1] == 'file':
+            values = g[3] if len(g) > 3 else ''
+            selects = np.fromstring(values, dtype=np.int32, sep=' ') > 0
+            select_area[g[2]] = selects
 
     # number of boundary lines
     nbounds = len(coeff_lst)
@@ -443,18 +547,18 @@ def load_mosaic(filename):
 
     # check whether the number of boundaries and the number of selected areas
     # are consistent.
+    consistent = True
     for filename, selects in select_area.items():
-        if len(selects) != nbounds + 1:
+        if selects.size != nbounds + 1:
             logger.error(
                 'Length of selected area for "%s" (%d) != N(boundaries) + 1'%(
-                filename, len(selects)))
+                filename, selects.size))
+            consistent = False
 
     # check whether every element in the final mosaic is 1.
-    for i in range(nbounds+1):
-        sumi = 0
-        for selects in select_area.values():
-            sumi += selects[i]
-        if sumi != 1:
+    if consistent and len(select_area) > 0:
+        sum_lst = np.sum(list(select_area.values()), axis=0)
+        for i in np.nonzero(sum_lst != 1)[0]:
             logger.error('Multiple selections for area number %d'%i)
 
     return coeff_lst, select_area
@@ -578,15 +682,13 @@ def mosaic_flat_auto(aperture_set_lst, max_count, name_lst):
         if len(nosat_lst)>0:
             # if there are apertures without saturated pixels, find the one
             # with largest median values
-            nosat_sort_lst = sorted(nosat_lst.items(),
+            pick_name, (pick_aper, pick_aperloc) = max(nosat_lst.items(),
                                 key=lambda item: item[1][1].median)
-            pick_name, (pick_aper, pick_aperloc) = nosat_sort_lst[-1]
         else:
             # all apertures are saturated. Then find the aperture that has
             # the least number of saturated pixels.
-            sat_sort_lst = sorted(list1.items(),
+            pick_name, (pick_aper, pick_aperloc) = min(list1.items(),
                                 key=lambda item: item[1][1].nsat)
-            pick_name, (pick_aper, pick_aperloc) = sat_sort_lst[0]
 
         # give a new attribute called "tracename"
         setattr(pick_aperloc, 'tracename', pick_name)
@@ -600,10 +702,13 @@ def mosaic_flat_auto(aperture_set_lst, max_count, name_lst):
     # resort all the aperloc
     mosaic_aperset.sort()
 
+    # sort the mosaiced apertures only once
+    sorted_aperloc_lst = sorted(mosaic_aperset.items())
+
     # make a summary and write it to log
     message = ['Flat Mosaic Information',
                 'aper, yposition, flatname, N (sat), Max (count)']
-    for aper, aper_loc in sorted(mosaic_aperset.items()):
+    for aper, aper_loc in sorted_aperloc_lst:
         message.append('{:4d} {:7.2f} {:^15s} {:4d} {:10.1f}'.format(
             aper, aper_loc.get_center(), aper_loc.tracename, aper_loc.nsat,
             aper_loc.max))
@@ -613,7 +718,7 @@ def mosaic_flat_auto(aperture_set_lst, max_count, name_lst):
     # get the shape of the first aperloc in mosaic_aperset
     shape = list(mosaic_aperset.values())[0].shape
 
-    for aper, aper_loc in sorted(mosaic_aperset.items()):
+    for aper, aper_loc in sorted_aperloc_lst:
         if aper_loc.shape != shape:
             logger.error(
                 'Shape of Aper %d (%d, %d) does not match the shape (%d, %d)'%(
@@ -659,9 +764,12 @@ def mosaic_images(image_lst, mosaic_aperset):
                     for name in image_lst.keys()}
 
     h, w = shape
-    yy, xx = np.mgrid[:h:, :w:]
     xlst = np.arange(w)
     ylst = np.arange(h)
+    # column and row vectors to be broadcasted when comparing with the cut
+    # boundaries
+    xcol = xlst.reshape((1,-1))
+    yrow = ylst.reshape((-1,1))
 
     for iaper, (aper, aper_loc) in enumerate(sorted(mosaic_aperset.items())):
         tracename = aper_loc.tracename
@@ -673,14 +781,14 @@ def mosaic_images(image_lst, mosaic_aperset):
                 # aperture along Y axis
                 center_line = aper_loc.position(ylst)
                 prev_center_line = prev_aper_loc.position(ylst)
-                cut_bound = (center_line + prev_center_line)/2.
-                m = xx > np.round(cut_bound)
+                cut_bound = np.round((center_line + prev_center_line)/2.)
+                m = xcol > cut_bound.reshape((-1,1))
             elif aper_loc.direct == 1:
                 # aperture along X axis
                 center_line = aper_loc.position(xlst)
                 prev_center_line = prev_aper_loc.position(xlst)
-                cut_bound = (center_line + prev_center_line)/2.
-                m = yy > np.round(cut_bound)
+                cut_bound = np.round((center_line + prev_center_line)/2.)
+                m = yrow > cut_bound.reshape((1,-1))
             maskdata_lst[prev_tracename][m] = False
             maskdata_lst[tracename][m] = True
         else:
@@ -694,7 +802,9 @@ def mosaic_images(image_lst, mosaic_aperset):
         _image = image_lst[_name]
         # filter out NaN values. otherwise the NaN will be passed to final image
         _image[np.isnan(_image)] = 0
-        mosaic_image += _image*_maskdata
+        # the masks do not overlap. copy the selected pixels in one pass
+        # without creating the temporary _image*_maskdata
+        np.copyto(mosaic_image, _image, where=_maskdata)
 
     return mosaic_image
 
@@ -739,13 +849,14 @@ def save_mosaic_reg(filename, coeff_lst, disp_axis, shape, npoints=20):
         shape (tuple): A tuple containing the shape of the image.
         npoints (int): Number of sampling points.
     """
-    outfile = open(filename, 'w')
-    outfile.write('# Region file format: DS9 version 4.1'+os.linesep)
-    #outfile.write('# Filename: flat.fits'+os.linesep)
-    outfile.write('global color=green dashlist=8 3 width=1 font="normal" ')
-    outfile.write('select=0 highlite=1 dash=0 fixed=1 edit=0 move=0 ')
-    outfile.write('delete=0 include=1 source=1'+os.linesep)
-    outfile.write('physical'+os.linesep)
+    # header lines of the region file
+    lines = []
+    lines.append('# Region file format: DS9 version 4.1'+os.linesep)
+    #lines.append('# Filename: flat.fits'+os.linesep)
+    lines.append('global color=green dashlist=8 3 width=1 font="normal" '
+                 'select=0 highlite=1 dash=0 fixed=1 edit=0 move=0 '
+                 'delete=0 include=1 source=1'+os.linesep)
+    lines.append('physical'+os.linesep)
 
     h, w = shape
 
@@ -756,16 +867,32 @@ def save_mosaic_reg(filename, coeff_lst, disp_axis, shape, npoints=20):
         # orders are along X axis
         n_disp, n_xdisp = w, h
 
-    pseudo_x  = np.linspace(0.5, n_disp-0.5, npoints)
-    pseudo_xr = np.roll(pseudo_x, -1)
-    for coeff in coeff_lst:
-        pseudo_y  = np.polyval(coeff, pseudo_x/n_disp)*n_xdisp
-        pseudo_yr = np.roll(pseudo_y, -1)
-        for x1, y1, x2, y2 in list(zip(pseudo_x, pseudo_y, pseudo_xr, pseudo_yr))[0:-1]:
-            if disp_axis == 0:
-                x1, y1, x2, y2 = y1, x1, y2, x2
-            outfile.write('line(%.1f,%.1f,%.1f,%.1f) # line=0 0%s'%(
-                           x1+1,y1+1,x2+1,y2+1, os.linesep))
+    pseudo_x = np.linspace(0.5, n_disp-0.5, npoints)
+
+    if len(coeff_lst) > 0:
+        # evaluate all boundaries in one call. shape of coeff_arr is
+        # (ncoeff, nbound, 1), which is broadcast against pseudo_x
+        coeff_arr = np.array(coeff_lst).T[:,:,np.newaxis]
+        pseudo_y = _estrin_polyval(coeff_arr, pseudo_x/n_disp)
+        pseudo_y *= n_xdisp
+    else:
+        pseudo_y = np.zeros((0, npoints))
+    pseudo_x = np.tile(pseudo_x, (pseudo_y.shape[0], 1))
+
+    # start and end points of all line segments. shape = (ncoeff, npoints-1)
+    x1, x2 = pseudo_x[:,0:-1], pseudo_x[:,1:]
+    y1, y2 = pseudo_y[:,0:-1], pseudo_y[:,1:]
+    if disp_axis == 0:
+        x1, y1, x2, y2 = y1, x1, y2, x2
+
+    segments = np.column_stack((x1.ravel(), y1.ravel(),
+                                x2.ravel(), y2.ravel())) + 1
+
+    outfile = open(filename, 'w')
+    outfile.writelines(lines)
+    # format all line segments in one call
+    np.savetxt(outfile, segments, fmt='line(%.1f,%.1f,%.1f,%.1f) # line=0 0',
+               newline=os.linesep)
     outfile.close()
 
 def default_smooth_aperpar_A(newx_lst, ypara, fitmask, group_lst, npoints):
@@ -1969,7 +2096,8 @@ def get_slit_flat(data, mask, apertureset, spectra1d,
     newx = np.arange(w)
     flatmap = np.ones_like(data, dtype=np.float64)
 
-    yy, xx = np.mgrid[:h:,:w:]
+    # broadcastable row and column indices instead of full 2-D grids
+    yy, xx = np.ix_(np.arange(h), np.arange(w))
 
     for aper, aper_loc in sorted(apertureset.items()):
         spec = spectra1d[aper]
@@ -1984,7 +2112,7 @@ def get_slit_flat(data, mask, apertureset, spectra1d,
         lower_line = position - lower_limit
         upper_line = position + upper_limit
         mask = np.zeros_like(data, dtype=np.bool)
-        mask[:,d1:d2] = (yy[:,d1:d2] > lower_line)*(yy[:,d1:d2] < upper_line)
+        mask[:,d1:d2] = (yy > lower_line)*(yy < upper_line)
 
         # fit flux
         yfit, fmask = smooth_flux_func(newx, fluxdata, w)
@@ -1,5 +1,6 @@
 import os
 import logging
+import functools
 
 logger = logging.getLogger(__name__)
 
@@ -7,6 +8,7 @@ import numpy as np
 import astropy.io.fits as fits
 import scipy.interpolate as intp
 import scipy.signal
+import scipy.ndimage
 
 def combine_images(data,
         mode       = 'mean',  # mode = ['mean'|'sum'|'median']
@@ -58,68 +60,65 @@ def combine_images(data,
         elif w>2000 and w%2==0: dx = w//2
         else:                   dx = w
 
+        # all segmentations have the same shape. allocate the buffer of the
+        # sorted values once, and reuse it for every segmentation
+        npix = dy*dx
+        # raw frames are usually 16-bit integers. sorting them in their own
+        # type moves 4 times less data than sorting float64 copies, while
+        # the statistics are always computed in float64
+        if data.dtype.kind in 'ui' and data.dtype.itemsize <= 2:
+            sort_dtype = data.dtype
+        else:
+            sort_dtype = np.float64
+        sorted_data = np.empty((nimage, npix), dtype=sort_dtype)
+
         # segmentation loop starts here
-        for y1 in np.arange(0, h, dy):
+        for y1 in range(0, h, dy):
             y2 = y1 + dy
-            for x1 in np.arange(0, w, dx):
+            for x1 in range(0, w, dx):
                 x2 = x1 + dx
 
                 small_data = data[:,y1:y2,x1:x2]
                 nz, ny, nx = small_data.shape
+
+                # sort the values of every pixel once. the unmasked values of
+                # a pixel are always a contiguous range [lo, hi) of its sorted
+                # values
+                sorted_data.reshape(nz, ny, nx)[...] = small_data
+                sorted_data.sort(axis=0)
+
                 # generate a mask containing the positions of maximum pixel
-                # along the first dimension
-                if mask is None:
-                    small_mask = np.zeros_like(small_data, dtype=np.bool)
-                elif isinstance(mask, str):
-                    if mask == 'max':
-                        small_mask = (np.mgrid[0:nz,0:ny,0:nx][0]
-                                      == small_data.argmax(axis=0))
-                    elif mask == 'min':
-                        small_mask = (np.mgrid[0:nz,0:ny,0:nx][0]
-                                      == small_data.argmin(axis=0))
-                    else:
-                        pass
-                else:
-                    pass
-                
-                for niter in range(maxiter):
-                    mdata = np.ma.masked_array(small_data, mask=small_mask)
-                    mean = mdata.mean(axis=0, dtype=np.float64).data
-                    std  = mdata.std(axis=0, dtype=np.float64).data
-                    new_small_mask = np.ones_like(small_mask, dtype=np.bool)
-                    for i in np.arange(nimage):
-                        chunk = small_data[i,:,:]
-                
-                        # parse upper clipping
-                        if upper_clip is None:
-                            # mask1 = [False....]
-                            mask1 = np.zeros_like(chunk, dtype=np.bool)
-                        else:
-                            mask1 = chunk > mean + abs(upper_clip)*std
-                
-                        # parse lower clipping
-                        if lower_clip is None:
-                            # mask2 = [False....]
-                            mask2 = np.zeros_like(chunk, dtype=np.bool)
-                        else:
-                            mask2 = chunk < mean - abs(lower_clip)*std
-                
-                        new_small_mask[i,:,:] = np.logical_or(mask1, mask2)
-
-                    if new_small_mask.sum() == small_mask.sum():
-                        break
-                    small_mask = new_small_mask
-                
-                mdata = np.ma.masked_array(small_data, mask=small_mask)
-                
-                if mode == 'mean':
-                    mean = mdata.mean(axis=0).data
-                    final_array[y1:y2,x1:x2] = mean
-                elif mode == 'sum':
-                    mean = mdata.mean(axis=0).data
-                    final_array[y1:y2,x1:x2] = mean*nimage
+                # along the first dimension, i.e. the last (or first) sorted
+                # value
+                lo = np.zeros(npix, dtype=np.int64)
+                hi = np.full(npix, nz, dtype=np.int64)
+                if mask == 'max':
+                    hi -= 1
+                elif mask == 'min':
+                    lo += 1
+
+                # clip the pixels by updating their unmasked ranges
+                _sigma_clip_sorted(sorted_data, lo, hi,
+                                   upper_clip, lower_clip, maxiter)
+
+                # pixels with all values clipped are filled with NaN
+                n = hi - lo
+                empty = n == 0
+                if mode in ('mean', 'sum'):
+                    mean, _ = _get_range_stats(sorted_data, lo, hi)
+                    if mode == 'sum':
+                        mean = mean*nimage
+                    final_array[y1:y2,x1:x2] = mean.reshape(ny, nx)
                 elif mode == 'median':
-                    final_array[y1:y2,x1:x2] = np.median(mdata, axis=0).data
+                    # median of the unmasked range of the sorted values. the
+                    # indices of empty ranges are clamped into the array
+                    pix_index = np.arange(npix)
+                    i1 = np.clip((lo+hi-1)//2, 0, nz-1)
+                    i2 = np.clip((lo+hi)//2,   0, nz-1)
+                    m1 = sorted_data.take(i1*npix + pix_index)
+                    m2 = sorted_data.take(i2*npix + pix_index)
+                    median = np.where(empty, np.nan, (m1/2. + m2/2.))
+                    final_array[y1:y2,x1:x2] = median.reshape(ny, nx)
                 else:
                     raise ValueError
         # segmentation loop ends here
@@ -130,11 +129,136 @@ def combine_images(data,
         elif mode == 'sum':
             return data.sum(axis=0)
         elif mode == 'median':
-            return np.median(data, axis=0)
+            return _median_axis0(data)
         else:
             raise ValueError
             return None
 
+def _median_axis0(data):
+    """Get the median of a datacube along the first axis.
+
+    The result is the same as ``np.median(data, axis=0)``, but only the
+    middle element(s) are selected with :func:`numpy.partition`, without the
+    NaN checks of :func:`numpy.median` on the partitioned cube.
+
+    Args:
+        data (:class:`numpy.ndarray`): Datacube of input images.
+
+    Returns:
+        :class:`numpy.ndarray`: Median image array.
+
+    """
+    nimage = data.shape[0]
+    k = nimage//2
+    if nimage%2 == 1:
+        median = np.partition(data, k, axis=0)[k]
+        if data.dtype.kind in 'uib':
+            median = median.astype(np.float64)
+    else:
+        part = np.partition(data, [k-1, k], axis=0)
+        median = part[k-1]/2. + part[k]/2.
+
+    # any NaN value makes the median of the pixel NaN
+    if data.dtype.kind in 'fc':
+        nan_mask = np.isnan(data).any(axis=0)
+        if nan_mask.any():
+            median[nan_mask] = np.nan
+    return median
+
+def _get_range_stats(sorted_data, lo, hi):
+    """Get the mean and standard deviation of the unmasked sorted values.
+
+    Args:
+        sorted_data (:class:`numpy.ndarray`): 2-D array of the values sorted
+            along the first axis, with a shape of (*nz*, *npix*).
+        lo (:class:`numpy.ndarray`): Lower bounds of the unmasked ranges.
+        hi (:class:`numpy.ndarray`): Upper bounds of the unmasked ranges.
+
+    Returns:
+        tuple: A tuple containing the means and standard deviations of the
+            values in the ranges [**lo**, **hi**). Both are NaN for empty
+            ranges.
+
+    """
+    nz = sorted_data.shape[0]
+    rank = np.arange(nz).reshape(-1, 1)
+    inrange = (rank >= lo) & (rank < hi)
+    n = hi - lo
+    # the same two-pass mean and standard deviation as the masked arrays,
+    # which are exact for a range with only one value
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(inrange, sorted_data, 0).sum(axis=0,
+                                                     dtype=np.float64)/n
+        dev2 = np.where(inrange, np.square(sorted_data - mean), 0)
+        std  = np.sqrt(dev2.sum(axis=0)/n)
+    return mean, std
+
+def _sigma_clip_sorted(sorted_data, lo, hi, upper_clip, lower_clip, maxiter):
+    """Iterative sigma-clipping of pixels with sorted values.
+
+    The unmasked values of every pixel are a contiguous range [**lo**,
+    **hi**) of its values sorted along the first axis, so the clipping only
+    moves the bounds of the ranges. This kernel is vectorized over all
+    pixels.
+
+    The thresholds are widened by the rounding error of the mean, so a range
+    is never clipped away by its own mean, e.g. for a pixel with only one
+    unmasked value or with all values equal. Ranges may only become empty
+    (**hi** == **lo**) if the clipping thresholds are smaller than one
+    standard deviation, and callers must handle such pixels.
+
+    Args:
+        sorted_data (:class:`numpy.ndarray`): 2-D array of the values sorted
+            along the first axis, with a shape of (*nz*, *npix*).
+        lo (:class:`numpy.ndarray`): Initial lower bounds of the unmasked
+            ranges. Updated in place.
+        hi (:class:`numpy.ndarray`): Initial upper bounds of the unmasked
+            ranges. Updated in place.
+        upper_clip (float): Upper threshold of the sigma-clipping.
+        lower_clip (float): Lower threshold of the sigma-clipping.
+        maxiter (int): Maximum number of iterations.
+
+    See also:
+        :func:`combine_images`
+    """
+    nz, npix = sorted_data.shape
+    eps = np.finfo(np.float64).eps
+
+    # indices of the pixels whose masks changed in the last iteration. the
+    # masks of other pixels will not change any more, so only these pixels
+    # are clipped again.
+    active = np.arange(npix)
+    for niter in range(maxiter):
+        act_lo, act_hi = lo[active], hi[active]
+        n = act_hi - act_lo
+        act_data = sorted_data[:, active]
+        mean, std = _get_range_stats(act_data, act_lo, act_hi)
+        # rounding error of the summed mean
+        tol = nz*eps*np.abs(mean)
+
+        # new ranges of the unmasked sorted values
+        with np.errstate(invalid='ignore'):
+            if upper_clip is None:
+                new_hi = np.full_like(act_hi, nz)
+            else:
+                upper = mean + abs(upper_clip)*std + tol
+                new_hi = (act_data <= upper).sum(axis=0)
+            if lower_clip is None:
+                new_lo = np.zeros_like(act_lo)
+            else:
+                lower = mean - abs(lower_clip)*std - tol
+                new_lo = (act_data < lower).sum(axis=0)
+
+        # the converged pixels keep their masks, so comparing the numbers of
+        # unmasked active pixels is the same as comparing the numbers of
+        # masked pixels in all pixels
+        if (new_hi - new_lo).sum() == n.sum():
+            break
+        changed = (new_lo != act_lo) | (new_hi != act_hi)
+        lo[active] = new_lo
+        hi[active] = new_hi
+        active = active[changed]
+
 def make_mask():
     """
     Generate a mask
@@ -184,13 +308,72 @@ def savitzky_golay_2d(z, window_length, order, mode='reflect', cval=None,
     yhalf = ywin//2
     xhalf = xwin//2
 
+    coeff = _get_savitzky_golay_2d_coeff(ywin, xwin, yorder, xorder)
+
+    # solve system and convolve
+    if derivative is None:
+        kernels = [coeff[0].reshape((ywin, xwin))]
+    elif derivative == 'col':
+        kernels = [-coeff[1].reshape((ywin, xwin))]
+    elif derivative == 'row':
+        kernels = [-coeff[2].reshape((ywin, xwin))]
+    elif derivative == 'both':
+        kernels = [-coeff[2].reshape((ywin, xwin)),
+                   -coeff[1].reshape((ywin, xwin))]
+    else:
+        return None
+
+    if ywin*xwin <= 64 and mode in ('reflect', 'mirror', 'nearest',
+                                     'constant'):
+        # direct convolution is faster than FFT for small kernels. the edge
+        # modes are the same as in scipy.ndimage, so the input array does not
+        # need to be expanded
+        if mode == 'constant' and cval is None:
+            raise ValueError
+        z = np.asarray(z, dtype=np.float64)
+        result = [scipy.ndimage.convolve(z, kernel, mode=mode,
+                    cval=(0.0 if cval is None else cval))
+                  for kernel in kernels]
+    else:
+        Z = expand_2darray(z, (yhalf, xhalf), mode=mode, cval=cval)
+        result = [scipy.signal.fftconvolve(Z, kernel, mode='valid')
+                  for kernel in kernels]
+
+    if derivative == 'both':
+        return tuple(result)
+    else:
+        return result[0]
+
+@functools.lru_cache(maxsize=64)
+def _get_savitzky_golay_2d_coeff(ywin, xwin, yorder, xorder):
+    """Get the coefficients of the 2D Savitzky-Golay filter.
+
+    The coefficients only depend on the window sizes and orders, and are
+    shared by repeated calls of :func:`savitzky_golay_2d`. They are
+    read-only.
+
+    Args:
+        ywin (int): Window size along *y* direction.
+        xwin (int): Window size along *x* direction.
+        yorder (int): Degree of polynomial along *y* direction.
+        xorder (int): Degree of polynomial along *x* direction.
+
+    Returns:
+        :class:`numpy.ndarray`: Pseudo-inverse of the design matrix. Its
+            first three rows are the kernels of the smoothed values and the
+            derivatives along *x* and *y* directions.
+
+    """
+    # half of the window size
+    yhalf = ywin//2
+    xhalf = xwin//2
+
     # exponents of the polynomial. 
     # p(x,y) = a0 + a1*x + a2*y + a3*x^2 + a4*y^2 + a5*x*y + ...
     # this line gives a list of two item tuple. Each tuple contains
     # the exponents of the k-th term. First element of tuple is for x
     # second element for y.
     # Ex. exps = [(0,0), (1,0), (0,1), (2,0), (1,1), (0,2), ...]
-    maxorder = max(xorder, yorder)
     exps = [(k-n, n) for k in range(max(xorder, yorder)+1) for n in range(k+1)
             if k-n <= xorder and n <= yorder]
 
@@ -205,25 +388,9 @@ def savitzky_golay_2d(z, window_length, order, mode='reflect', cval=None,
     for i, exp in enumerate(exps):
         A[:, i] = (dx**exp[0])*(dy**exp[1])
 
-    Z = expand_2darray(z, (yhalf, xhalf), mode=mode, cval=cval)
-
-    # solve system and convolve
-    if derivative is None:
-        m = np.linalg.pinv(A)[0].reshape((ywin, xwin))
-        return scipy.signal.fftconvolve(Z, m, mode='valid')
-    elif derivative == 'col':
-        c = np.linalg.pinv(A)[1].reshape((ywin, xwin))
-        return scipy.signal.fftconvolve(Z, -c, mode='valid')
-    elif derivative == 'row':
-        r = np.linalg.pinv(A)[2].rehsape((ywin, xwin))
-        return scipy.signal.fftconvolve(Z, -r, mode='valid')
-    elif derivative == 'both':
-        c = np.linalg.pinv(A)[1].reshape((ywin, xwin))
-        r = np.linalg.pinv(A)[2].rehsape((ywin, xwin))
-        return (scipy.signal.fftconvolve(Z, -r, mode='valid'),
-                scipy.signal.fftconvolve(Z, -c, mode='valid'))
-    else:
-        return None
+    coeff = np.linalg.pinv(A)
+    coeff.setflags(write=False)
+    return coeff
 
 def array_to_table(array):
     """Convert the non-zeros elements of a Numpy array to a stuctured array.
@@ -269,14 +436,12 @@ def array_to_table(array):
     names, formats = list(zip(*types))
     custom = np.dtype({'names': names, 'formats': formats})
     
-    table = []
+    # fill the columns of the whole table at once
     ind = np.nonzero(array)
-    for coord, value in zip(zip(*ind), array[ind]):
-        row = list(coord)
-        row.append(value)
-        row = np.array(tuple(row), dtype=custom)
-        table.append(row)
-    table = np.array(table, dtype=custom)
+    table = np.empty(ind[0].size, dtype=custom)
+    for name, coord in zip(names[0:-1], ind):
+        table[name] = coord
+    table['value'] = array[ind]
     return(table)
 
 def table_to_array(table, shape):
@@ -327,7 +492,9 @@ def table_to_array(table, shape):
 
     array = np.zeros(shape, dtype=table.dtype[-1].type)
     coords = tuple(table[col] for col in table.dtype.names[0:-1])
-    array[coords] = table['value']
+    # write the values through the flat indices of the elements
+    index = np.ravel_multi_index(coords, shape, order='C')
+    np.put(array, index, table['value'])
 
     return array
 
@@ -362,31 +529,40 @@ def fix_pixels(data, mask, direction, method):
 
     if direction == 0:
         # fix along Y axis
-        x = np.arange(data.shape[0])
-        cols = np.nonzero(masklist)[0]
-        for col in cols:
-            m = mask[:,col]
-            rm = ~m
-            y = data[:,col]
-            f = intp.InterpolatedUnivariateSpline(x[rm],y[rm],k=k)
-            newdata[:,col][m] = f(x[m])
+        _data, _mask, _newdata = data, mask, newdata
     elif direction == 1:
-        # fix along X axis
-        x = np.arange(data.shape[1])
-        rows = np.nonzero(masklist)[0]
-        for row in rows:
-            m = mask[row,:]
-            rm = ~m
-            y = data[row,:]
-            f = intp.InterpolatedUnivariateSpline(x[rm],y[rm],k=k)
-            newdata[row,:][m] = f(x[m])
+        # fix along X axis. the rows are the columns of the transposed views
+        _data, _mask, _newdata = data.T, mask.T, newdata.T
     else:
         print('direction must be 0 or 1')
         raise ValueError
 
+    x = np.arange(_data.shape[0])
+    cols = np.nonzero(masklist)[0]
+    # the columns sharing the same mask pattern (e.g. bad columns of the
+    # detector) are interpolated together with one spline of 2-D values.
+    # make_interp_spline gives the same not-a-knot interpolating splines as
+    # InterpolatedUnivariateSpline, including the extrapolation at the ends
+    group_lst = {}
+    for col in cols:
+        group_lst.setdefault(_mask[:, col].tobytes(), []).append(col)
+    for group in group_lst.values():
+        m = _mask[:, group[0]]
+        rm = ~m
+        f = intp.make_interp_spline(x[rm], _data[np.ix_(rm, group)], k=k)
+        _newdata[np.ix_(m, group)] = f(x[m])
+
     return newdata
 
 
+# edge modes of expand_2darray() and the corresponding modes of np.pad()
+_pad_mode_lst = {
+    'reflect':  'symmetric',
+    'mirror':   'reflect',
+    'nearest':  'edge',
+    'constant': 'constant',
+    }
+
 def expand_2darray(z, n, mode, cval=None):
     """Expand a two-dimensional array with given edge modes.
 
@@ -401,7 +577,7 @@ def expand_2darray(z, n, mode, cval=None):
 
 
     """
-    if isinstance(z, int):
+    if isinstance(n, int):
         nt, nb, nl, nr = n, n, n, n
     if isinstance(n, (tuple, list)):
         if len(n) == 2:
@@ -412,83 +588,41 @@ def expand_2darray(z, n, mode, cval=None):
         else:
             raise ValueError
 
+    # the edge modes are the same as those in scipy.ndimage, while the numpy
+    # names are different
+    if mode in _pad_mode_lst:
+        if mode == 'constant':
+            if cval is None:
+                raise ValueError
+            kwargs = {'constant_values': cval}
+        else:
+            kwargs = {}
+        return np.pad(np.asarray(z, dtype=np.float64), ((nt, nb), (nl, nr)),
+                      mode=_pad_mode_lst[mode], **kwargs)
+
+    if mode != 'z-symmetry':
+        raise ValueError
+
     new_shape = (z.shape[0] + nt + nb, z.shape[1] + nl + nr)
     Z = np.zeros(new_shape)
 
     Z[nt:-nb, nl:-nr] = z
 
-    # pad input array with appropriate values at the four borders
-    if mode == 'reflect':
-        # top, bottom, left, and right bands
-        Z[:nt, nl:-nr]  = np.flipud(z[:nt, :])
-        Z[-nb:, nl:-nr] = np.flipud(z[-nb:, :])
-        Z[nt:-nb, :nl]  = np.fliplr(z[:, :nl])
-        Z[nt:-nb, -nr:] = np.fliplr(z[:, -nr:])
-
-        # top-left, top-right, bottom-left, and bottom-right corners
-        Z[:nt, :nl]   = np.flipud(np.fliplr(z[:nt, :nl]))
-        Z[:nt, -nr:]  = np.flipud(np.fliplr(z[:nt, -nr:]))
-        Z[-nb:, :nl]  = np.flipud(np.fliplr(z[-nb:, :nl]))
-        Z[-nb:, -nr:] = np.flipud(np.fliplr(z[-nb:, -nr:]))
-
-    elif mode == 'mirror':
-        # top, bottom, left, and right bands
-        Z[:nt, nl:-nr]  = np.flipud(z[1:1+nt, :])
-        Z[-nb:, nl:-nr] = np.flipud(z[-nb-1:-1, :])
-        Z[nt:-nb, :nl]  = np.fliplr(z[:, 1:1+nl])
-        Z[nt:-nb, -nr:] = np.fliplr(z[:, -nr-1:-1])
-
-        # top-left, top-right, bottom-left, and bottom-right corners
-        Z[:nt, :nl]   = np.flipud(np.fliplr(z[1:1+nt, 1:1+nl]))
-        Z[:nt, -nr:]  = np.flipud(np.fliplr(z[1:1+nt, -nr-1:-1]))
-        Z[-nb:, :nl]  = np.flipud(np.fliplr(z[-nb-1:-1, 1:1+nl]))
-        Z[-nb:, -nr:] = np.flipud(np.fliplr(z[-nb-1:-1, -nr-1:-1]))
-
-    elif mode == 'nearest':
-        # top, bottom, left, and right bands
-        Z[:nt, nl:-nr]  = z[0, :]
-        Z[-nb:, nl:-nr] = z[-1, :]
-        Z[nt:-nb, :nl]  = z[:, 0].reshape(-1,1)
-        Z[nt:-nb, -nr:] = z[:, -1].reshape(-1,1)
-
-        # top-left, top-right, bottom-left, and bottom-right corners
-        Z[:nt, :nl]   = z[0, 0]
-        Z[:nt, -nr:]  = z[0, -1]
-        Z[-nb:, :nl]  = z[-1, 0]
-        Z[-nb:, -nr:] = z[-1, -1]
-
-    elif mode == 'constant':
-        if cval is None:
-            raise ValueError
-        # top, bottom, left, and right bands
-        Z[:nt, nl:-nr]  = cval
-        Z[-nb:, nl:-nr] = cval
-        Z[nt:-nb, :nl]  = cval
-        Z[nt:-nb, -nr:] = cval
-
-        # top-left, top-right, bottom-left, and bottom-right corners
-        Z[:nt, :nl]   = cval
-        Z[:nt, -nr:]  = cval
-        Z[-nb:, :nl]  = cval
-        Z[-nb:, -nr:] = cval
-
-    elif mode == 'z-symmetry':
-        # top, bottom, left, and right bands
-        Z[:nt, nl:-nr]  = z[0, :] - (np.flipud(z[1:1+nt, :]) - z[0, :])
-        Z[-nb:, nl:-nr] = z[-1, :] - (np.flipud(z[-nb-1:-1, :]) - z[-1, :])
-        band = np.tile(z[:,0].reshape(-1,1), [1,nl])
-        Z[nt:-nb, :nl] = band - (np.fliplr(z[:, 1:1+nl]) - band)
-        band = np.tile(z[:,-1].reshape(-1,1), [1,nr])
-        Z[nt:-nb, -nr:] = band - (np.fliplr(z[:, -nr-1:-1]) - band)
-
-        # top-left, top-right, bottom-left, and bottom-right corners
-        Z[:nt,:nl]   = z[0,0] - (np.flipud(np.fliplr(z[1:1+nt,1:1+nl])) - z[0,0])
-        Z[:nt,-nr:]  = z[0,-1] - (np.flipud(np.fliplr(z[1:1+nt,-nr-1:-1])) - z[0,-1])
-        Z[-nb:,:nl]  = z[-1,0] - (np.flipud(np.fliplr(z[-nb-1:-1,1:1+nl])) - z[-1,0])
-        Z[-nb:,-nr:] = z[-1,-1] - (np.flipud(np.fliplr(z[-nb-1:-1,-nr-1:-1])) - z[-1,-1])
-
-    else:
-        raise ValueError
+    # pad input array with z-symmetric values at the four borders, i.e.
+    # point reflections about the edge pixels
+    # top, bottom, left, and right bands
+    Z[:nt, nl:-nr]  = z[0, :] - (np.flipud(z[1:1+nt, :]) - z[0, :])
+    Z[-nb:, nl:-nr] = z[-1, :] - (np.flipud(z[-nb-1:-1, :]) - z[-1, :])
+    band = np.tile(z[:,0].reshape(-1,1), [1,nl])
+    Z[nt:-nb, :nl] = band - (np.fliplr(z[:, 1:1+nl]) - band)
+    band = np.tile(z[:,-1].reshape(-1,1), [1,nr])
+    Z[nt:-nb, -nr:] = band - (np.fliplr(z[:, -nr-1:-1]) - band)
+
+    # top-left, top-right, bottom-left, and bottom-right corners
+    Z[:nt,:nl]   = z[0,0] - (np.flipud(np.fliplr(z[1:1+nt,1:1+nl])) - z[0,0])
+    Z[:nt,-nr:]  = z[0,-1] - (np.flipud(np.fliplr(z[1:1+nt,-nr-1:-1])) - z[0,-1])
+    Z[-nb:,:nl]  = z[-1,0] - (np.flipud(np.fliplr(z[-nb-1:-1,1:1+nl])) - z[-1,0])
+    Z[-nb:,-nr:] = z[-1,-1] - (np.flipud(np.fliplr(z[-nb-1:-1,-nr-1:-1])) - z[-1,-1])
 
     return Z
 
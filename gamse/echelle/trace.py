@@ -3,9 +3,11 @@ import logging
 logger = logging.getLogger(__name__)
 
 import os
+import ast
 import time
 import math
 import copy
+import functools
 import numpy as np
 from numpy.polynomial import Polynomial, Chebyshev
 import astropy.io.fits   as fits
@@ -18,7 +20,113 @@ import matplotlib.ticker as tck
 from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.figure import Figure
 
-from ..utils.onedarray import get_local_minima, pairwise, derivative
+from ..utils.onedarray import get_local_minima, derivative
+
+def _clenshaw(coef, x, domain):
+    """Evaluate a Chebyshev series with the Clenshaw recurrence.
+
+    This is equivalent to calling a :class:`numpy.polynomial.Chebyshev`
+    instance with the default window of [-1, 1], but avoids the overhead of
+    the polynomial class.
+
+    Args:
+        coef (:class:`numpy.ndarray`): Coefficients of the Chebyshev series.
+        x (*float* or :class:`numpy.ndarray`): Input values.
+        domain (tuple): Domain of the Chebyshev series.
+
+    Returns:
+        *float* or :class:`numpy.ndarray`: Values of the Chebyshev series.
+    """
+    d0, d1 = domain
+    # map x from domain to [-1, 1]
+    t = (2*np.asarray(x, dtype=np.float64) - (d0 + d1))/(d1 - d0)
+    if len(coef) == 1:
+        return coef[0] + 0*t
+    t2 = 2*t
+    b1, b2 = 0., 0.
+    for c in coef[:0:-1]:
+        b1, b2 = t2*b1 - b2 + c, b1
+    return coef[0] + t*b1 - b2
+
+@functools.lru_cache(maxsize=4)
+def _get_dense_grid(h, density):
+    """Get the dense grid used to find peaks in cross-sections.
+
+    The arrays only depend on the image height, and are shared by repeated
+    calls on images of the same shape. They are read-only.
+
+    Args:
+        h (int): Number of pixels along the cross-dispersion direction.
+        density (int): Number of grid points per pixel.
+
+    Returns:
+        tuple: A tuple containing:
+
+            * **dense_y** (:class:`numpy.ndarray`): Grid coordinates.
+            * **frac_pow** (:class:`numpy.ndarray`): Powers (3, 2, 1, 0) of
+              the fractional offsets of **dense_y** within a pixel interval.
+
+    """
+    dense_y = np.linspace(0, h-1, (h-1)*density+1)
+    frac = np.arange(density)/density
+    frac_pow = np.array([frac**3, frac**2, frac, np.ones(density)])
+    dense_y.setflags(write=False)
+    frac_pow.setflags(write=False)
+    return dense_y, frac_pow
+
+def _chebfit_batch(xfit_lst, yfit_lst, domain_lst, deg):
+    """Least-squares fit of Chebyshev series to several sets of nodes at once.
+
+    The nodes are padded to the same length with zero weights, and the normal
+    equations of all sets are solved with a single batched call.
+
+    Args:
+        xfit_lst (list): List of X coordinates of nodes for every set.
+        yfit_lst (list): List of Y coordinates of nodes for every set.
+        domain_lst (list): List of domains for every set.
+        deg (int): Degree of the Chebyshev series.
+
+    Returns:
+        list: List of :class:`numpy.polynomial.Chebyshev` instances.
+    """
+    nset = len(xfit_lst)
+    if nset == 0:
+        return []
+    npts = max(len(xfit) for xfit in xfit_lst)
+    t    = np.zeros((nset, npts))
+    y    = np.zeros((nset, npts))
+    wt   = np.zeros((nset, npts))
+    for i, (xfit, yfit, (d0, d1)) in enumerate(
+            zip(xfit_lst, yfit_lst, domain_lst)):
+        n = len(xfit)
+        # map x from domain to [-1, 1]
+        t[i, :n]  = (2*np.asarray(xfit, dtype=np.float64) - (d0 + d1))/(d1 - d0)
+        y[i, :n]  = yfit
+        wt[i, :n] = 1
+
+    vander = np.polynomial.chebyshev.chebvander(t, deg)
+    wvander = vander*wt[:,:,np.newaxis]
+    a = np.einsum('sik,sil->skl', wvander, vander)
+    b = np.einsum('sik,si->sk', wvander, y)
+
+    # sets with too few nodes have singular normal equations
+    good = wt.sum(axis=1) > deg
+    coef = np.zeros((nset, deg+1))
+    if good.any():
+        coef[good] = np.linalg.solve(a[good], b[good][...,np.newaxis])[...,0]
+
+    # solve the singular sets with a rank-tolerant lstsq on their rows of the
+    # same Vandermonde matrix, scaling the columns as Chebyshev.fit does
+    for i in np.flatnonzero(~good):
+        n = len(xfit_lst[i])
+        v = vander[i, :n]
+        scl = np.sqrt((v*v).sum(axis=0))
+        scl[scl == 0] = 1
+        c = np.linalg.lstsq(v/scl, y[i, :n], rcond=n*np.finfo(v.dtype).eps)[0]
+        coef[i] = c/scl
+
+    return [Chebyshev(c, domain=domain)
+            for c, domain in zip(coef, domain_lst)]
 
 class ApertureLocation(object):
     """Location of an echelle order.
@@ -48,22 +156,19 @@ class ApertureLocation(object):
         # filter the None values in (xdata, ydata)
         xydata = [(x,y) for x, y in zip(xdata, ydata)
                   if x is not None and y is not None]
-        xnodes, ynodes = zip(*xydata)
+        xnodes, ynodes = np.array(xydata).T
 
         # sort the nodes according to x coordinates
-        xnodes, ynodes = np.array(xnodes), np.array(ynodes)
         if self.direction == 0:
             # order is along y axis
-            xnodes = xnodes[ynodes.argsort()]
-            ynodes = np.sort(ynodes)
+            idx = ynodes.argsort()
         elif self.direction == 1:
             # order is along x axis
-            ynodes = ynodes[xnodes.argsort()]
-            xnodes = np.sort(xnodes)
-
-        xydata = [(x, y) for x, y in zip(xnodes, ynodes)]
+            idx = xnodes.argsort()
+        xnodes, ynodes = xnodes[idx], ynodes[idx]
 
-        setattr(self, 'nodes_%s'%key, xydata)
+        # nodes are saved as a tuple of (xnodes, ynodes) arrays
+        setattr(self, 'nodes_%s'%key, (xnodes, ynodes))
 
     def fit_nodes(self, key, degree, clipping, maxiter):
         """Fit the polynomial iteratively with sigma-clipping method and get the
@@ -79,8 +184,7 @@ class ApertureLocation(object):
         """
 
         h, w = self.shape
-        nodes = getattr(self, 'nodes_%s'%key)
-        xnodes, ynodes = zip(*nodes)
+        xnodes, ynodes = getattr(self, 'nodes_%s'%key)
         
         # normalize to [0, 1)
         xfit = np.array(xnodes, dtype=np.float32)/w
@@ -95,6 +199,13 @@ class ApertureLocation(object):
 
         # initialize mask
         mask = np.ones_like(xfit, dtype=np.bool)
+
+        # build the Vandermonde matrix only once. columns are in decreasing
+        # powers as in np.polyfit, so that a lower degree uses the last
+        # (deg+1) columns
+        vander = np.vander(np.float64(xfit), degree+1)
+        yfit64 = np.float64(yfit)
+
         for niter in range(maxiter):
             # determine the appropriate degree of polynomial
             npoints = mask.sum()
@@ -104,13 +215,12 @@ class ApertureLocation(object):
             else:
                 deg = min(npoints-1, degree)
 
-            coeff = np.polyfit(xfit[mask], yfit[mask], deg=deg)
-            res = yfit - np.polyval(coeff, xfit)
+            v = vander[:, degree-deg:]
+            coeff = np.linalg.lstsq(v[mask], yfit64[mask], rcond=None)[0]
+            res = yfit64 - v.dot(coeff)
             mean = res[mask].mean()
             std  = res[mask].std(ddof=1)
-            m1 = res < mean + clipping*std
-            m2 = res > mean - clipping*std
-            new_mask = m1*m2
+            new_mask = np.abs(res - mean) < clipping*std
             if new_mask.sum() == mask.sum():
                 break
             mask = new_mask
@@ -130,6 +240,11 @@ class ApertureLocation(object):
 
     def set_position(self, poly):
         setattr(self, 'position', poly)
+        # cache the coefficients and domain for fast evaluation
+        self._coef   = np.array(poly.coef, dtype=np.float64)
+        self._domain = (float(poly.domain[0]), float(poly.domain[1]))
+        # the center is re-evaluated on the next call of get_center()
+        self._center = None
 
     def get_position(self):
         """Get postions for all pixels in this echelle order.
@@ -139,7 +254,7 @@ class ApertureLocation(object):
         """
         # echelle order along y axis
         coords1 = np.arange(self.shape[self.direct])
-        coords2 = self.position(coords1)
+        coords2 = _clenshaw(self._coef, coords1, self._domain)
         return coords1, coords2
 
     def get_center(self):
@@ -148,15 +263,18 @@ class ApertureLocation(object):
         Returns:
             *float*: coordinate of the center pixel.
         """
+        if self._center is not None:
+            return self._center
         h, w = self.shape
         if self.direct == 0:
             # aperture along Y direction
-            center = self.position(h/2.)
+            center = _clenshaw(self._coef, h/2., self._domain)
         elif self.direct == 1:
             # aperture along X direction
-            center = self.position(w/2.)
+            center = _clenshaw(self._coef, w/2., self._domain)
         else:
-            print('Cannot recognize direction: '+self.direct)
+            logger.error('Cannot recognize direction: %s'%str(self.direct))
+        self._center = center
         return center
 
     def __str__(self):
@@ -192,8 +310,8 @@ class ApertureLocation(object):
         for key in ['lower', 'center', 'upper']:
             key1 = 'nodes_%s'%key
             if hasattr(self, key1):
-                nodes = getattr(self, key1)
-                strlst = ['(%g, %g)'%(x,y) for x, y in nodes]
+                xnodes, ynodes = getattr(self, key1)
+                strlst = ['(%g, %g)'%(x,y) for x, y in zip(xnodes, ynodes)]
                 string += '%6s = [%s]%s'%(key1, ', '.join(strlst), os.linesep)
 
         # find coefficients
@@ -233,7 +351,7 @@ class ApertureLocation(object):
 
         """
         if self.direct != aperloc.direct:
-            print('ApertureLocations have different directions')
+            logger.error('ApertureLocations have different directions')
             return None
         return self.get_center() - aperloc.get_center()
 
@@ -243,9 +361,12 @@ class ApertureSet(object):
     Attributes:
         _dict (dict): Dict containing aperture numbers and
             :class:`ApertureLocation` instances.
+        _sorted_cache (list): Cached list of `(aperture, aperture_loc)`
+            sorted by aperture numbers, or *None* if it needs to be rebuilt.
     """
     def __init__(self, *args, **kwargs):
         self._dict = {}
+        self._sorted_cache = None
         for key, value in kwargs.items():
             setattr(self, key, value)
 
@@ -254,6 +375,7 @@ class ApertureSet(object):
 
     def __setitem__(self, key, value):
         self._dict[key] = value
+        self._sorted_cache = None
 
     def __len__(self):
         return len(self._dict)
@@ -270,12 +392,22 @@ class ApertureSet(object):
     def values(self):
         return self._dict.values()
 
+    def sorted_items(self):
+        """Get the apertures sorted by aperture numbers.
+
+        Returns:
+            *list*: A list of `(aperture, aperture_loc)` tuples.
+        """
+        if self._sorted_cache is None:
+            self._sorted_cache = sorted(self._dict.items())
+        return self._sorted_cache
+
     def copy(self):
         return copy.deepcopy(self)
 
     def __str__(self):
         string = ''
-        for aper, aper_loc in sorted(self._dict.items()):
+        for aper, aper_loc in self.sorted_items():
             string += 'APERTURE LOCATION %d%s'%(aper, os.linesep)
             string += aper_loc.to_string()
         return string
@@ -294,6 +426,7 @@ class ApertureSet(object):
         else:
             maxi = max(self._dict.keys())
             self._dict[maxi+1] = aperture_loc
+        self._sorted_cache = None
 
     def sort(self):
         """Sort the apertures according to their positions inside this instance.
@@ -302,6 +435,7 @@ class ApertureSet(object):
                               key=lambda aper_loc: aper_loc.get_center())
         for i in range(len(aperloc_lst)):
             self._dict[i] = aperloc_lst[i]
+        self._sorted_cache = None
 
     def save_txt(self, filename):
         """Save the aperture set into an ascii file.
@@ -332,7 +466,7 @@ class ApertureSet(object):
         outfile.write('source=1'+os.linesep)
         outfile.write('physical'+os.linesep)
 
-        for aper, aper_loc in sorted(self.items()):
+        for aper, aper_loc in self.sorted_items():
 
             domain = aper_loc.position.domain
             d1, d2 = int(domain[0]), int(domain[1])+1
@@ -342,7 +476,7 @@ class ApertureSet(object):
             if aper_loc.direct == 1:
                 # write text in the left edge
                 x = d1-6
-                y = aper_loc.position(x)
+                y = _clenshaw(aper_loc._coef, x, aper_loc._domain)
                 if transpose:
                     x, y = y, x
                     angle = 90
@@ -354,7 +488,7 @@ class ApertureSet(object):
 
                 # write text in the right edge
                 x = d2-1+6
-                y = aper_loc.position(x)
+                y = _clenshaw(aper_loc._coef, x, aper_loc._domain)
                 if transpose:
                     x, y = y, x
                     angle = 90
@@ -366,7 +500,7 @@ class ApertureSet(object):
 
                 # write text in the center
                 x = (d1+d2)/2.
-                y = aper_loc.position(x)
+                y = _clenshaw(aper_loc._coef, x, aper_loc._domain)
                 if transpose:
                     x, y = y, x
                     angle = 90
@@ -392,13 +526,14 @@ class ApertureSet(object):
 
                 # draw lines
                 x = np.linspace(d1, d2, 50)
-                y = aper_loc.position(x)
+                y = _clenshaw(aper_loc._coef, x, aper_loc._domain)
                 if transpose:
                     x, y = y, x
-                for (x1,x2), (y1, y2) in zip(pairwise(x), pairwise(y)):
-                    text = 'line({:7.2f},{:7.2f},{:7.2f},{:7.2f})'.format(
-                            x1+1, y1+1, x2+1, y2+1)
-                    outfile.write(text+os.linesep)
+                # write all line segments of this aperture at once
+                segs = np.column_stack((x[:-1], y[:-1], x[1:], y[1:])) + 1
+                np.savetxt(outfile, segs,
+                           fmt='line(%7.2f,%7.2f,%7.2f,%7.2f)',
+                           newline=os.linesep)
 
         outfile.close()
 
@@ -424,24 +559,60 @@ class ApertureSet(object):
         if channel is not None:
             prefix += ' CHANNLE '+channel
 
-        for aper, aper_loc in sorted(self._dict.items()):
+        # collect the cards of all apertures and add them to the header in a
+        # single call
+        cards = []
+        for aper, aper_loc in self.sorted_items():
             prefix2 = '{:s} APERTURE {:03d}'.format(prefix, aper)
-            header[prefix2 + ' DIRECT']  = aper_loc.direct
-            header[prefix2 + ' SHAPE0']  = aper_loc.shape[0]
-            header[prefix2 + ' SHAPE1']  = aper_loc.shape[1]
+            cards.append((prefix2 + ' DIRECT',  aper_loc.direct))
+            cards.append((prefix2 + ' SHAPE0',  aper_loc.shape[0]))
+            cards.append((prefix2 + ' SHAPE1',  aper_loc.shape[1]))
             for ic, c in enumerate(aper_loc.position.coef):
-                header[prefix2 + ' COEFF %d'%ic] = c
-            header[prefix2 + ' DOMAIN0'] = aper_loc.position.domain[0]
-            header[prefix2 + ' DOMAIN1'] = aper_loc.position.domain[1]
-            header[prefix2 + ' NSAT']    = aper_loc.nsat
-            header[prefix2 + ' MEAN']    = aper_loc.mean
-            header[prefix2 + ' MEDIAN']  = aper_loc.median
-            header[prefix2 + ' MAX']     = aper_loc.max
+                cards.append((prefix2 + ' COEFF %d'%ic, c))
+            cards.append((prefix2 + ' DOMAIN0', aper_loc.position.domain[0]))
+            cards.append((prefix2 + ' DOMAIN1', aper_loc.position.domain[1]))
+            cards.append((prefix2 + ' NSAT',    aper_loc.nsat))
+            cards.append((prefix2 + ' MEAN',    aper_loc.mean))
+            cards.append((prefix2 + ' MEDIAN',  aper_loc.median))
+            cards.append((prefix2 + ' MAX',     aper_loc.max))
+
+        # existing keywords are updated in place, as header[key] = value does
+        header.extend(cards, update=True)
 
         return header
 
     def __iter__(self):
-        return _ApertureSetIterator(self._dict)
+        return iter(self._dict)
+
+    def centers_array(self):
+        """Get the central coordinates of all apertures.
+
+        Returns:
+            :class:`numpy.ndarray`: Array of central coordinates sorted by
+                aperture numbers.
+        """
+        items = self.sorted_items()
+
+        # evaluate the centers not computed yet in a single Clenshaw sweep,
+        # each aperture at the middle of its own dispersion axis. they are
+        # then cached in the ApertureLocation instances.
+        missing = [aper_loc for aper, aper_loc in items
+                   if aper_loc._center is None and aper_loc.direct in (0, 1)]
+        if len(missing) > 1:
+            ncoef  = max(aper_loc._coef.size for aper_loc in missing)
+            coef   = np.zeros((ncoef, len(missing)))
+            domain = np.zeros((2, len(missing)))
+            x      = np.zeros(len(missing))
+            for i, aper_loc in enumerate(missing):
+                coef[:aper_loc._coef.size, i] = aper_loc._coef
+                domain[:, i] = aper_loc._domain
+                h, w = aper_loc.shape
+                x[i] = h/2. if aper_loc.direct == 0 else w/2.
+            for aper_loc, center in zip(missing, _clenshaw(coef, x, domain)):
+                aper_loc._center = center
+
+        return np.fromiter((aper_loc.get_center() for aper, aper_loc in items),
+                           dtype=np.float64, count=len(items))
 
     def get_local_separation(self, aper):
         """Get the local separation in pixels per aperture number in the center
@@ -454,10 +625,8 @@ class ApertureSet(object):
             *float*: Local separation in pixels per aperture number.
         """
 
-        aper_lst, center_lst = [], []
-        for _aper, _aper_loc in sorted(self.items()):
-            aper_lst.append(_aper)
-            center_lst.append(_aper_loc.get_center())
+        aper_lst = sorted(self.keys())
+        center_lst = self.centers_array()
 
         separation_lst = derivative(aper_lst, center_lst)
         i = aper_lst.index(aper)
@@ -488,19 +657,23 @@ class ApertureSet(object):
             *int*: Offset between the two aperture sets.
         """
 
+        # build the sorted aperture and center arrays of both this instance
+        # and the input aperset
+        aper_lst1 = np.array(sorted(self.keys()))
+        center_lst1 = self.centers_array()
+        aper_lst2 = np.array(sorted(aperset.keys()))
+        center_lst2 = aperset.centers_array()
+
         # first step, search an aperture number that close to the center of all
         # apertures, and apears in both ApertureSet.
-        # build the center list of all apertures of this instance
-        center_lst1 = {aper: aper_loc.get_center()
-                        for aper, aper_loc in self.items()}
         # find the median of the centers
-        middle_center = np.median(list(center_lst1.values()))
+        middle_center = np.median(center_lst1)
         # build the distance list to the center for all apertures
-        dist_to_center = {aper: abs(c-middle_center)
-                            for aper, c in center_lst1.items()}
+        dist_to_center = np.abs(center_lst1 - middle_center)
         # begin to scan the apertures from the aperture that has the least
         # distance to the middle
-        for aper in sorted(dist_to_center, key=dist_to_center.get):
+        for i in np.argsort(dist_to_center, kind='stable'):
+            aper = int(aper_lst1[i])
             if aper in aperset:
                 break
 
@@ -533,29 +706,26 @@ class ApertureSet(object):
 
         offset_lst = range(o1, o2+1)
 
-        # find the center dict for every aperture for both this aperset and the
-        # input aperset
-        center_lst2 = {aper: aper_loc.get_center()
-                        for aper, aper_loc in aperset.items()}
-
-        # search the offset
-        median_diff_lst = []
-        for offset in offset_lst:
-            diff_lst = []
-            for aper in sorted(center_lst1):
-                if aper+offset in center_lst1 and aper in center_lst2:
-                    diff = center_lst1[aper+offset] - yshift - center_lst2[aper]
-                    diff_lst.append(diff)
-            # use the median value of the diff_lst
-            median_diff = np.median(diff_lst)
-            median_diff_lst.append(median_diff)
+        # search all offsets at once. for every aperture of this instance
+        # that also appears in the input aperset, find the center of the
+        # aperture (aper + offset) of this instance
+        offsets = np.array(offset_lst)
+        target = aper_lst1[np.newaxis,:] + offsets[:,np.newaxis]
+        idx1 = np.minimum(np.searchsorted(aper_lst1, target), aper_lst1.size-1)
+        idx2 = np.minimum(np.searchsorted(aper_lst2, aper_lst1),
+                          aper_lst2.size-1)
+        m = (aper_lst1[idx1] == target)*(aper_lst2[idx2] == aper_lst1)
+        diff = center_lst1[idx1] - yshift - center_lst2[idx2]
+        # use the median value of the differences for every offset
+        median_diff_lst = np.nanmedian(np.where(m, diff, np.nan), axis=1)
 
         # logging
-        message_lst = []
-        for o, diff in zip(offset_lst, median_diff_lst):
-            msg = 'offset = {:2d}: diff = {:+7.2f}'.format(o, diff)
-            message_lst.append(msg)
-        logger.debug((os.linesep+'  ').join(message_lst))
+        if logger.isEnabledFor(logging.DEBUG):
+            message_lst = []
+            for o, diff in zip(offset_lst, median_diff_lst):
+                msg = 'offset = {:2d}: diff = {:+7.2f}'.format(o, diff)
+                message_lst.append(msg)
+            logger.debug((os.linesep+'  ').join(message_lst))
 
         # find the offset with least absolute value of median diff
         i = np.abs(median_diff_lst).argmin()
@@ -573,6 +743,7 @@ class ApertureSet(object):
         for _aper, _aper_loc in self.items():
             new_dict[_aper+offset] = _aper_loc
         self._dict = new_dict
+        self._sorted_cache = None
 
     def add_offset(self, offset):
         """Add an offset to each aperture.
@@ -595,7 +766,39 @@ class ApertureSet(object):
                 all orders.
             
         """
-        return {aper: aperloc.position(x) for aper,aperloc in self.items()}
+        aper_lst = list(self.keys())
+        return dict(zip(aper_lst, self._eval_positions(aper_lst, x)))
+
+    def _eval_positions(self, aper_lst, x):
+        """Evaluate the central positions of several apertures in one
+        Clenshaw sweep.
+
+        Args:
+            aper_lst (list): List of apertures.
+            x (*int* or :class:`numpy.ndarray`): Input *X* coordiantes shared
+                by all apertures.
+
+        Returns:
+            :class:`numpy.ndarray`: Array of positions with the aperture
+                along the first axis.
+        """
+        if len(aper_lst) == 0:
+            return np.zeros((0,) + np.shape(x))
+
+        # stack the coefficients and domains of all apertures. The
+        # coefficients are padded with zeros for lower-degree polynomials.
+        ncoef = max(self[aper]._coef.size for aper in aper_lst)
+        coef   = np.zeros((ncoef, len(aper_lst)))
+        domain = np.zeros((2, len(aper_lst)))
+        for i, aper in enumerate(aper_lst):
+            aperloc = self[aper]
+            coef[:aperloc._coef.size, i] = aperloc._coef
+            domain[:, i] = aperloc._domain
+
+        # apertures along the first axis of the output, x along the others
+        shape = (len(aper_lst),) + (1,)*np.ndim(x)
+        return _clenshaw(coef.reshape((ncoef,)+shape), x,
+                         domain.reshape((2,)+shape))
 
     def get_boundaries(self, x):
         """Get upper and lower boundaries of all echelle orders.
@@ -608,50 +811,17 @@ class ApertureSet(object):
             *dict*: A dict of `{aperture: (lower, upper)}`, where `lower` and
                 `upper` are boundary arries.
         """
-        lower_bounds = {}
-        upper_bounds = {}
-        prev_aper     = None
-        prev_position = None
-        for aper, aperloc in sorted(self.items()):
-            position = aperloc.position(x)
-            if prev_aper is not None:
-                mid = (position + prev_position)/2
-                lower_bounds[aper]      = mid
-                upper_bounds[prev_aper] = mid
-            prev_position = position
-            prev_aper     = aper
-
-        # find the lower bound for the first aperture
-        minaper = min(self.keys())
-        position = self[minaper].position(x)
-        dist = upper_bounds[minaper] - position
-        lower_bounds[minaper] = position - dist
- 
-        # find the upper bound for the last aperture
-        maxaper = max(self.keys())
-        position = self[maxaper].position(x)
-        dist = position - lower_bounds[maxaper]
-        upper_bounds[maxaper] = position + dist
-
-        return {aper: (lower_bounds[aper], upper_bounds[aper])
-                for aper in self.keys()}
-
-class _ApertureSetIterator(object):
-    """Interator class for :class:`ApertureSet`.
-    """
-    def __init__(self, item_dict):
-        self.item_dict = item_dict
-        self.n = len(self.item_dict)
-        self.i = 0
-    def __iter__(self):
-        return self
-    def __next__(self):
-        if self.i < self.n:
-            i = self.i
-            self.i += 1
-            return list(self.item_dict.keys())[i]
-        else:
-            raise StopIteration()
+        aper_lst = [aper for aper, aper_loc in self.sorted_items()]
+        positions = self._eval_positions(aper_lst, x)
+
+        # boundaries between adjacent apertures are the mid-points
+        mids = (positions[1:] + positions[:-1])/2
+        lower_bounds = np.concatenate((positions[0:1]*2 - mids[0:1], mids))
+        upper_bounds = np.concatenate((mids, positions[-1:]*2 - mids[-1:]))
+
+        bounds = {aper: (lower_bounds[i], upper_bounds[i])
+                  for i, aper in enumerate(aper_lst)}
+        return {aper: bounds[aper] for aper in self.keys()}
 
 
 class TraceFigureCommon(Figure):
@@ -682,6 +852,94 @@ class TraceFigureCommon(Figure):
             bbox3.x0, y0, bbox3.width, bbox3.height
             ])
 
+# switch of the figures prepared for the paper. they are only used to
+# illustrate the tracing algorithm, and are skipped in normal reductions
+_plot_paper_fig = False
+
+def _create_paper_figures(logdata, sat_mask, sat_cmap):
+    """Create the figures illustrating the order tracing in the paper.
+
+    Args:
+        logdata (:class:`numpy.ndarray`): Logarithm of the image data.
+        sat_mask (:class:`numpy.ndarray`): Mask of saturated pixels.
+        sat_cmap (:class:`matplotlib.colors.Colormap`): Colormap of the
+            saturated pixels.
+
+    Returns:
+        tuple: The image figure, its main and mini axes, the stacked
+            cross-section figure and its axes.
+
+    """
+    # create an image shown in paper
+    fig1p = plt.figure(figsize=(7,6.7), dpi=150)
+    ax1p = fig1p.add_axes([0.13, 0.10, 0.85, 0.87])
+    ax1p2 = fig1p.add_axes([0.13, 0.09, 0.85, 0.91],facecolor='none')
+    ax1m = fig1p.add_axes([0.53, 0.10, 0.45, 0.45])
+    ax1p.imshow(logdata,cmap='gray',interpolation='none')
+    ax1m.imshow(logdata,cmap='gray',interpolation='none', vmin=0.9, vmax=2.2)
+    ax1p.imshow(sat_mask, interpolation='none',cmap=sat_cmap)
+    for x in [0.3,0.4,0.5,0.6,0.7]:
+        ax1p2.axvline(x=x, ls='--', lw=1, color='k')
+    ax1p2.arrow(0.5-0.005, 0.985, -0.05, 0, width=0.002, head_width=0.01, color='k', edgecolor='k')
+    ax1p2.arrow(0.5+0.005, 0.985, +0.05, 0, width=0.002, head_width=0.01, color='k', edgecolor='k')
+    ax1p2.set_axis_off()
+
+    fig2p = plt.figure(figsize=(7,4), dpi=150)
+    ax2p = fig2p.add_axes([0.13, 0.16, 0.84, 0.80])
+
+    return fig1p, ax1p, ax1m, fig2p, ax2p
+
+def _save_paper_figures(fig1p, ax1p, ax1m, fig2p, ax2p, h, w, ylim):
+    """Adjust and save the figures created by :func:`_create_paper_figures`.
+
+    Args:
+        fig1p (:class:`matplotlib.figure.Figure`): Image figure.
+        ax1p (:class:`matplotlib.axes.Axes`): Main axes of the image figure.
+        ax1m (:class:`matplotlib.axes.Axes`): Mini axes of the image figure.
+        fig2p (:class:`matplotlib.figure.Figure`): Stacked cross-section
+            figure.
+        ax2p (:class:`matplotlib.axes.Axes`): Axes of the stacked
+            cross-section figure.
+        h (int): Height of the image.
+        w (int): Width of the image.
+        ylim (tuple): Range of the stacked cross-section along Y axis.
+
+    """
+    # adjust figure 1 in paper
+    ax1p.xaxis.set_major_locator(tck.MultipleLocator(500))
+    ax1p.xaxis.set_minor_locator(tck.MultipleLocator(100))
+    ax1p.yaxis.set_major_locator(tck.MultipleLocator(500))
+    ax1p.yaxis.set_minor_locator(tck.MultipleLocator(100))
+    for tick in ax1p.xaxis.get_major_ticks():
+        tick.label1.set_fontsize(13)
+    for tick in ax1p.yaxis.get_major_ticks():
+        tick.label1.set_fontsize(13)
+    ax1p.set_xlim(0,w-1)
+    ax1p.set_ylim(h-1,0)
+    ax1p.set_xlabel('X', fontsize=18)
+    ax1p.set_ylabel('Y', fontsize=18)
+    ax1m.set_xlim(1600, w-1)
+    ax1m.set_ylim(h-1, 1600)
+    ax1m.set_xticks([])
+    ax1m.set_yticks([])
+    figfile='testaaa'
+    fig1p.savefig(figfile+'.pdf')
+
+    # adjust figure 2 in paper
+    ax2p.xaxis.set_major_locator(tck.MultipleLocator(500))
+    ax2p.xaxis.set_minor_locator(tck.MultipleLocator(100))
+    for tick in ax2p.xaxis.get_major_ticks():
+        tick.label1.set_fontsize(13)
+    for tick in ax2p.yaxis.get_major_ticks():
+        tick.label1.set_fontsize(13)
+    ax2p.set_yscale('log')
+    ax2p.set_xlabel('Y', fontsize=18)
+    ax2p.set_ylabel('Count', fontsize=18)
+    ax2p.set_xlim(*ylim)
+    fig2p.savefig(figfile+'_2.pdf')
+    plt.close(fig1p)
+    plt.close(fig2p)
+
 def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
         align_deg=2, filling=0.3, degree=3,
         display=True, fig=None):
@@ -702,6 +960,8 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
         filling (float): Fraction of detected pixels to total step of scanning.
         degree (int): Degree of polynomials to fit aperture locations.
         display (bool): If *True*, display a figure on the screen.
+        fig (:class:`TraceFigureCommon`): Figure to plot the tracing results.
+            Nothing is plotted if *None*.
 
     Returns:
         :class:`ApertureSet`: An :class:`ApertureSet` instance containing the
@@ -715,8 +975,11 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
 
     h, w = data.shape
 
-    # filter the pixels smaller than the input "minimum" value
-    logdata = np.log10(np.maximum(data, minimum))
+    # filter the pixels smaller than the input "minimum" value. the clipping
+    # and the logarithm share one float32 buffer, as logdata is only used for
+    # peak finding and plotting
+    logdata = np.maximum(data, minimum, dtype=np.float32)
+    np.log10(logdata, out=logdata)
 
     # initialize order separation relation v.s. row number
     # find the proper type of separation. either a float or a polynomial object
@@ -746,49 +1009,37 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
         # separation is alreay a numpy ufunc
         fsep = separation
     else:
-        print('cannot understand the meaning of separation')
+        logger.error('cannot understand the meaning of separation')
         exit()
     # now fsep is an numpy unfunc telling you the order separations at any given
     # rows
 
-    fig.ax1.imshow(logdata,cmap='gray',interpolation='none')
     # fill saturation pixels with red
     sat_cmap = mcolors.LinearSegmentedColormap.from_list('TransRed',
                [(1,0,0,0), (1,0,0,0.8)], N=2)
-    fig.ax1.imshow(sat_mask, interpolation='none', cmap=sat_cmap)
     # fill bad pixels with blue
     bad_cmap = mcolors.LinearSegmentedColormap.from_list('TransBlue',
                [(0,0,1,0), (0,0,1,0.8)], N=2)
-    fig.ax1.imshow(bad_mask, interpolation='none', cmap=bad_cmap)
     # filll CCD gaps with green
     gap_cmap = mcolors.LinearSegmentedColormap.from_list('TransGreen',
                [(0,1,0,0), (0,1,0,0.8)], N=2)
-    fig.ax1.imshow(gap_mask, interpolation='none', cmap=gap_cmap)
-    fig.ax1.set_xlim(0,w-1)
-    fig.ax1.set_ylim(h-1,0)
-    fig.ax1.set_xlabel('X', fontsize=12)
-    fig.ax1.set_ylabel('Y', fontsize=12)
 
-    plot_paper_fig = False
+    # all plotting on the trace figure is skipped if no figure is given
+    if fig is not None:
+        fig.ax1.imshow(logdata,cmap='gray',interpolation='none')
+        fig.ax1.imshow(sat_mask, interpolation='none', cmap=sat_cmap)
+        fig.ax1.imshow(bad_mask, interpolation='none', cmap=bad_cmap)
+        fig.ax1.imshow(gap_mask, interpolation='none', cmap=gap_cmap)
+        fig.ax1.set_xlim(0,w-1)
+        fig.ax1.set_ylim(h-1,0)
+        fig.ax1.set_xlabel('X', fontsize=12)
+        fig.ax1.set_ylabel('Y', fontsize=12)
 
-    if plot_paper_fig:
-        # create an image shown in paper
-        fig1p = plt.figure(figsize=(7,6.7), dpi=150)
-        ax1p = fig1p.add_axes([0.13, 0.10, 0.85, 0.87])
-        ax1p2 = fig1p.add_axes([0.13, 0.09, 0.85, 0.91],facecolor='none')
-        ax1m = fig1p.add_axes([0.53, 0.10, 0.45, 0.45])
-        ax1p.imshow(logdata,cmap='gray',interpolation='none')
-        ax1m.imshow(logdata,cmap='gray',interpolation='none', vmin=0.9, vmax=2.2)
-        ax1p.imshow(sat_mask, interpolation='none',cmap=sat_cmap)
-        for x in [0.3,0.4,0.5,0.6,0.7]:
-            ax1p2.axvline(x=x, ls='--', lw=1, color='k')
-        ax1p2.arrow(0.5-0.005, 0.985, -0.05, 0, width=0.002, head_width=0.01, color='k', edgecolor='k')
-        ax1p2.arrow(0.5+0.005, 0.985, +0.05, 0, width=0.002, head_width=0.01, color='k', edgecolor='k')
-        ax1p2.set_axis_off()
-
-        fig2p = plt.figure(figsize=(7,4), dpi=150)
-        ax2p = fig2p.add_axes([0.13, 0.16, 0.84, 0.80])
+    plot_paper_fig = _plot_paper_fig
 
+    if plot_paper_fig:
+        fig1p, ax1p, ax1m, fig2p, ax2p = _create_paper_figures(
+                                            logdata, sat_mask, sat_cmap)
 
     # define a scroll function, which is used for mouse manipulation on pop-up
     # window
@@ -803,9 +1054,10 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
             fig.ax1.set_xlim(x1, x2)
             fig.ax1.set_ylim(y1, y2)
             fig.canvas.draw()
-    fig.canvas.mpl_connect('scroll_event', on_scroll)
-    fig.canvas.draw()
-    if display:
+    # rendering the figure is only needed when it is shown on the screen
+    if fig is not None and display:
+        fig.canvas.mpl_connect('scroll_event', on_scroll)
+        fig.canvas.draw()
         plt.show(block=False)
 
     x0 = w//2
@@ -827,6 +1079,13 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
     csec_nlst   = np.zeros(csec_i2 - csec_i1, dtype=np.int32)
     csec_maxlst = np.zeros(csec_i2 - csec_i1)
 
+    def stack_csec(i1, i2, flux):
+        # stack a cross-section into csec_lst, csec_nlst and csec_maxlst in
+        # place, without allocating temporary arrays
+        csec_lst[i1:i2] += flux
+        csec_nlst[i1:i2] += 1
+        np.maximum(csec_maxlst[i1:i2], flux, out=csec_maxlst[i1:i2])
+
     # two-directioal param list
     param_lst = {-1:[], 1:[]}
     nodes_lst = {}
@@ -848,15 +1107,15 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
             y_der = forward_der(x, p)
             dx = dy/y_der
             x = x - dx
-            if abs(dx) < 1e-7:
+            if np.all(np.abs(dx) < 1e-7):
                 break
         return x
-    def fitfunc(p, interfunc, n):
-        return interfunc(forward(np.arange(n), p[0:-1])) + p[-1]
-    def resfunc(p, interfunc, flux0, mask=None):
-        res_lst = flux0 - fitfunc(p, interfunc, flux0.size)
+    def fitfunc(p, interfunc, xarr):
+        return interfunc(forward(xarr, p[0:-1])) + p[-1]
+    def resfunc(p, interfunc, xarr, flux0, mask=None):
+        res_lst = flux0 - fitfunc(p, interfunc, xarr)
         if mask is None:
-            mask = np.ones_like(flux0, dtype=np.bool)
+            return res_lst
         return res_lst[mask]
     def find_shift(flux0, flux1, deg):
         #p0 = [1.0, 0.0, 0.0]
@@ -866,13 +1125,16 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
         p0 = [0.0 for i in range(deg+1)]
         p0[-3] = 1.0
 
-        interfunc = intp.InterpolatedUnivariateSpline(
-                    np.arange(flux1.size), flux1, k=3)
-        mask = np.ones_like(flux0, dtype=np.bool)
+        # the interpolating spline of flux1 and the pixel coordinates are
+        # built only once, and reused in every residual call
+        xarr = np.arange(flux1.size)
+        interfunc = intp.CubicSpline(xarr, flux1)
+        mask = np.ones_like(flux0, dtype=bool)
         clipping = 5.
         for i in range(10):
-            p, _ = opt.leastsq(resfunc, p0, args=(interfunc, flux0, mask))
-            res_lst = resfunc(p, interfunc, flux0)
+            p, _ = opt.leastsq(resfunc, p0,
+                               args=(interfunc, xarr, flux0, mask))
+            res_lst = resfunc(p, interfunc, xarr, flux0)
             std  = res_lst.std()
             mask1 = res_lst <  clipping*std
             mask2 = res_lst > -clipping*std
@@ -882,24 +1144,34 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
             mask = new_mask
         return p, mask
 
+    # normalized hanning cores used in find_local_peak, with their lengths as
+    # keys
+    hanning_lst = {}
+
     def find_local_peak(xdata, ydata, mask, smooth=None, figname=None):
         if figname is not None:
             fig = plt.figure(dpi=150, figsize=(8,6))
             ax = fig.gca()
             ax.plot(xdata, ydata, color='C0')
         if smooth is not None:
-            core = np.hanning(min(smooth, ydata.size))
-            core = core/core.sum()
             # length of core should not be smaller than length of ydata
             # otherwise the length of ydata after convolution is reduced
-            ydata = np.convolve(ydata, core, mode='same')
+            n = min(smooth, ydata.size)
+            if n not in hanning_lst:
+                core = np.hanning(n)
+                hanning_lst[n] = core/core.sum()
+            ydata = np.convolve(ydata, hanning_lst[n], mode='same')
         argmax = ydata.argmax()
         xmax = xdata[argmax]
         if argmax<2 or argmax>ydata.size-2:
             return xdata[xdata.size//2]
-        coeff = np.polyfit(xdata[argmax-1:argmax+2], ydata[argmax-1:argmax+2],deg=2)
-        a, b,c = coeff
-        ypeak = -b/2/a
+        # vertex of the parabola passing through the 3 points around the
+        # maximum pixel. xdata has a uniform step of 1 pixel
+        f1, f2, f3 = ydata[argmax-1:argmax+2]
+        denom = f1 - 2*f2 + f3
+        if denom == 0:
+            return xmax
+        ypeak = xmax + 0.5*(f1 - f3)/denom
         if figname is not None:
             ax.plot(xdata, ydata, color='C1')
             ax.axvline(x=ypeak, color='C1', ls='--')
@@ -909,37 +1181,50 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
     ############################################################################
 
     # generate a window list according to separations
-    dense_y = np.linspace(0, h-1, (h-1)*density+1)
+    dense_y, frac_pow = _get_dense_grid(h, density)
     separation_lst = fsep(dense_y)
     separation_lst = np.int32(np.round(separation_lst))
     window = 2*separation_lst*density+1
 
+    # pixel coordinates along the cross-dispersion direction. they are
+    # shared by the scan and the local peak searches, and must not be modified
+    yarr = np.arange(h)
+    yarr.setflags(write=False)
+
     # convolution core for the cross-sections. used to eliminate the "flat" tops
     # of the saturated orders
     core = np.hanning(int(fsep(h/2)))
     core /= core.sum()
+    # the first and last elements of a Hanning window are zeros. strip them
+    # to save two multiply-adds per pixel in every convolution of the scan
+    # loop. the results of mode='same' convolutions are unchanged.
+    if core.size > 2:
+        core = core[1:-1]
 
     while(True):
         # scan the image along X axis starting from the middle column
-        nodes_lst[x1] = []
         flux1 = logdata[:,x1]
         mask1 = (bad_mask[:, x1]==0)*(gap_mask[:, x1]==0)
         #flux1 = data[:,x1]
         #linflux1 = data[:,x1]
-        linflux1 = np.median(data[:,x1-2:x1+3], axis=1)
+        # median of the 5 neighbouring columns. x1 is always kept away from
+        # the edges of the image, so the 3rd smallest value is the median
+        linflux1 = np.partition(data[:,x1-2:x1+3], 2, axis=1)[:,2]
         #linflux1 = np.exp(flux1)
         #flux1 = sg.savgol_filter(flux1, window_length=5, polyorder=2)
         fixfunc = intp.InterpolatedUnivariateSpline(
-                np.arange(h)[mask1], flux1[mask1], k=3, ext=3)
-        flux1 = fixfunc(np.arange(h))
+                yarr[mask1], flux1[mask1], k=3, ext=3)
+        flux1 = fixfunc(yarr)
         flux1 = np.convolve(flux1, core, mode='same')
         if icol == 0:
             # will be used when changing the direction
             flux1_center = flux1
 
         # find peaks with Y precision of 1./density pixels
-        f = intp.InterpolatedUnivariateSpline(np.arange(flux1.size), flux1, k=3)
-        flux2 = f(dense_y)
+        # dense_y samples every pixel interval at the same fractional offsets,
+        # so the piecewise cubic is evaluated with a single matrix product
+        f = intp.CubicSpline(yarr, flux1)
+        flux2 = np.append((f.c.T @ frac_pow).ravel(), flux1[-1])
         imax, fmax = get_local_minima(-flux2, window=window)
         ymax = dense_y[imax]
         fmax = -fmax
@@ -952,37 +1237,31 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
 
         if icol == 0:
             # the middle column
-            for y,f in zip(ymax,fmax):
-                peak_lst.append((y,f))
-                nodes_lst[x1].append(y)
+            peak_lst.append(np.column_stack((ymax, fmax)))
             # convert to the stacked cross-section coordinate
             i1 = 0 - csec_i1
             i2 = h - csec_i1
             # stack the linear flux to the stacked cross-section
-            csec_lst[i1:i2] += linflux1
-            csec_nlst[i1:i2] += 1
-            csec_maxlst[i1:i2] = np.maximum(csec_maxlst[i1:i2],linflux1)
+            stack_csec(i1, i2, linflux1)
         else:
             # aperture alignment of each selected column, described by param
             param, _ = find_shift(flux0, flux1, deg=align_deg)
             param_lst[direction].append(param[0:-1])
 
-            for y, f in zip(ymax, fmax):
-                ystep = y
-                for param in param_lst[direction][::-1]:
-                    ystep = backward(ystep, param)
-                peak_lst.append((ystep,f))
-                nodes_lst[x1].append(y)
+            # back-project all peaks, together with the start and end pixels
+            # of this column, through the alignment chain at once
+            ystep = np.append(ymax, [0., h-1.])
+            for param in param_lst[direction][::-1]:
+                ystep = backward(ystep, param)
+
+            peak_lst.append(np.column_stack((ystep[:-2], fmax)))
 
             # find ysta & yend, the start and point pixel after aperture
             # alignment
-            ysta, yend = 0., h-1.
-            for param in param_lst[direction][::-1]:
-                ysta = backward(ysta, param)
-                yend = backward(yend, param)
+            ysta, yend = ystep[-2], ystep[-1]
             # interplote the new csection, from ysta to yend
             ynew = np.linspace(ysta, yend, h)
-            interfunc = intp.InterpolatedUnivariateSpline(ynew, linflux1, k=3)
+            interfunc = intp.CubicSpline(ynew, linflux1)
             # find the starting and ending indices for the new csection
             ysta_int = int(round(ysta))
             yend_int = int(round(yend))
@@ -992,16 +1271,14 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
             i1 = ysta_int - csec_i1
             i2 = yend_int + 1 - csec_i1
             # then, stack the cross-sections
-            csec_lst[i1:i2] += fnew
-            csec_nlst[i1:i2] += 1
-            csec_maxlst[i1:i2] = np.maximum(csec_maxlst[i1:i2],fnew)
+            stack_csec(i1, i2, fnew)
             # for debug purpose
             #fig.ax2.plot(np.arange(ysta_int, yend_int+1), fnew, 'y-', alpha=0.2)
-            if direction==-1:
+            if fig is not None and direction==-1:
                 fig.ax2.plot(np.arange(ysta_int, yend_int+1), fnew, '-',
                              lw=0.5, alpha=0.2)
 
-        nodes_lst[x1] = np.array(nodes_lst[x1])
+        nodes_lst[x1] = ymax
 
         x1 += direction*scan_step
         if x1 <= 10:
@@ -1055,18 +1332,20 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
     # convert back to stacked cross-section coordinate
     peaky += istart
 
-    message = []
-    for peak in peaky:
-        string = '{:4d} {:4d}'.format(peak+csec_i1, csec_win[peak])
-        message.append(string)
-    logger.debug((os.linesep+' '*3).join(message))
-
-    fig.ax2.plot(csec_ylst[istart:iend], csec_lst[istart:iend], '-', color='C0',
-            lw=0.8)
-    fig.ax2.set_yscale('log')
-    fig.ax2.set_xlabel('Y', fontsize=12)
-    fig.ax2.set_ylabel('Count', fontsize=12)
-    fig.ax2.set_ylim(0.5,)
+    if logger.isEnabledFor(logging.DEBUG):
+        message = []
+        for peak in peaky:
+            string = '{:4d} {:4d}'.format(peak+csec_i1, csec_win[peak])
+            message.append(string)
+        logger.debug((os.linesep+' '*3).join(message))
+
+    if fig is not None:
+        fig.ax2.plot(csec_ylst[istart:iend], csec_lst[istart:iend], '-',
+                color='C0', lw=0.8)
+        fig.ax2.set_yscale('log')
+        fig.ax2.set_xlabel('Y', fontsize=12)
+        fig.ax2.set_ylabel('Count', fontsize=12)
+        fig.ax2.set_ylim(0.5,)
 
     if plot_paper_fig:
         # plot the stacked cross-section in paper figure
@@ -1078,17 +1357,15 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
 
     # parse peaks
     # cutx, cuty, cutn are the stacked peak list
-    peak_lst = np.array(peak_lst)
+    peak_lst = np.vstack(peak_lst)
     peak_ylst = peak_lst[:,0]
     peak_flst = peak_lst[:,1]
     peak_yintlst = np.int32(np.round(peak_ylst))
-    cutf = np.zeros_like(csec_lst)
-    cutn = np.zeros_like(csec_lst, dtype=np.int32)
-    for y,f in zip(peak_yintlst,peak_flst):
-        cutn[y-csec_i1] += 1
-        cutf[y-csec_i1] += f
-        # for debug purpose
-        #fig.ax2.axvline(csec_ylst[y-csec_i1], color='y', ls='--', alpha=0.2)
+    # count the peaks and sum their fluxes at every pixel of the stacked
+    # cross-section
+    peak_idx = peak_yintlst - csec_i1
+    cutn = np.bincount(peak_idx, minlength=csec_lst.size).astype(np.int32)
+    cutf = np.bincount(peak_idx, weights=peak_flst, minlength=csec_lst.size)
     # remove those element equal to one
     onemask = cutn == 1
     cutf[onemask] = 0
@@ -1096,157 +1373,180 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
     cuty = np.arange(cutn.size) + csec_i1
 
     #fig.ax2.plot(cuty[istart:iend], cutn[istart:iend],'r-',alpha=1.)
-    fig.ax3.fill_between(cuty[istart:iend], cutn[istart:iend],
-                        step='mid', color='C1')
+    if fig is not None:
+        fig.ax3.fill_between(cuty[istart:iend], cutn[istart:iend],
+                            step='mid', color='C1')
     if plot_paper_fig:
         # plot stacked peaks with yello in paper figure
         ax2p.fill_between(cuty[istart:iend], cutn[istart:iend],
                             step='mid', color='C1')
 
     # find central positions along Y axis for all apertures
-    message = []
-    mid_lst = []
-    for y in peaky:
-        f = csec_lst[y]
-        # find the local separation
-        sep = csec_separation_lst[y]
-        # search for the maximum value of cutn around y
-        i1, i2 = y-int(sep/2), y+int(sep/2)
-        ymax = cutn[i1:i2].argmax() + i1
-
-        #i1, i2 = ymax, ymax
-        #while(cutn[i1]>0):
-        #    i1 -= 1
-        #while(cutn[i2]>0):
-        #    i2 += 1
-        #ii1 = max(i1,ymax-int(sep/2))
-        #ii2 = min(i2,ymax+int(sep/2))
-
-        ii1 = y - int(sep/3)
-        ii2 = y + int(sep/3)
-        n = cutn[ii1:ii2].sum()
-
-        if n > csec_nlst[y]*filling:
-            mid_lst.append(csec_ylst[y])
-            select = 'yes'
-        else:
-            select = 'no'
-
-        # debug information in running log
-        info = {
-                    'y'     : csec_ylst[y],
-                    'ymax'  : csec_ylst[ymax],
-                    'i1'    : csec_ylst[ii1],
-                    'i2'    : csec_ylst[ii2],
-                    'n'     : n,
-                    'n_xsec': csec_nlst[y],
-                    'select': select,
-                    'peak'  : csec_ylst[y],
-                }
+    # count the stacked peaks within 1/3 of the local separation around every
+    # peak, using the running sum of cutn
+    sep_lst = csec_separation_lst[peaky]
+    ii1_lst = np.clip(peaky - sep_lst//3, 0, cutn.size-1)
+    ii2_lst = np.clip(peaky + sep_lst//3, 0, cutn.size-1)
+    cutn_cumsum = np.concatenate(([0], np.cumsum(cutn)))
+    n_lst = cutn_cumsum[ii2_lst] - cutn_cumsum[ii1_lst]
+    select_lst = n_lst > csec_nlst[peaky]*filling
+    mid_lst = list(csec_ylst[peaky[select_lst]])
+
+    # the table is only needed by the running log
+    if logger.isEnabledFor(logging.INFO):
+        message = []
         fmt = ' '.join(['{y:5d}','{ymax:5d}','{i1:5d}','{i2:5d}','{n:4d}',
                         '{n_xsec:4d}','{select:>5s}','{peak:5d}'])
-
-        message.append(fmt.format(**info))
-
-        # for debug purpose
-        #fig.ax2.axvline(csec_ylst[y], color='k', ls='--')
-
-    # write debug information
-    logger.info((os.linesep+' '*4).join(message))
+        for y, sep, ii1, ii2, n, select in zip(peaky, sep_lst, ii1_lst,
+                                               ii2_lst, n_lst, select_lst):
+            # search for the maximum value of cutn around y
+            i1, i2 = y-sep//2, y+sep//2
+            ymax = cutn[i1:i2].argmax() + i1
+
+            # debug information in running log
+            info = {
+                        'y'     : csec_ylst[y],
+                        'ymax'  : csec_ylst[ymax],
+                        'i1'    : csec_ylst[ii1],
+                        'i2'    : csec_ylst[ii2],
+                        'n'     : n,
+                        'n_xsec': csec_nlst[y],
+                        'select': 'yes' if select else 'no',
+                        'peak'  : csec_ylst[y],
+                    }
+            message.append(fmt.format(**info))
+
+        # write debug information
+        logger.info((os.linesep+' '*4).join(message))
 
     # check the first and last peak. If the separation is larger than 2x of 
-    # the local separation, remove them
+    # the local separation, remove them. the distances and local separations
+    # of all peaks are computed at once, and the removed peaks are sliced off
+    mid_arr = np.array(mid_lst)
+    dist_lst = np.diff(mid_arr)
+    local_sep_lst = np.float64(fsep(mid_arr))
+    i1, i2 = 0, mid_arr.size
     # check the last peak
-    while(len(mid_lst)>3):
-        sep = fsep(mid_lst[-1])
-        if mid_lst[-1] - mid_lst[-2] > 2*sep:
-            logger.info('Remove the last aperture at %d (distance=%d > 2 x %d)'%(
-                        mid_lst[-1], mid_lst[-1]-mid_lst[-2], sep))
-            mid_lst.pop(-1)
-        else:
-            break
+    while(i2 - i1 > 3 and dist_lst[i2-2] > 2*local_sep_lst[i2-1]):
+        logger.info('Remove the last aperture at %d (distance=%d > 2 x %d)'%(
+                    mid_arr[i2-1], dist_lst[i2-2], local_sep_lst[i2-1]))
+        i2 -= 1
 
     # check the first peak
-    while(len(mid_lst)>3):
-        sep = fsep(mid_lst[0])
-        if mid_lst[1] - mid_lst[0] > 2*sep:
-            logger.info('Remove the first aperture at %d (distance=%d > 2 x %d)'%(
-                        mid_lst[0], mid_lst[1]-mid_lst[0], sep))
-            mid_lst.pop(0)
-        else:
-            break
+    while(i2 - i1 > 3 and dist_lst[i1] > 2*local_sep_lst[i1]):
+        logger.info('Remove the first aperture at %d (distance=%d > 2 x %d)'%(
+                    mid_arr[i1], dist_lst[i1], local_sep_lst[i1]))
+        i1 += 1
+    mid_lst = list(mid_arr[i1:i2])
 
     # plot the aperture positions
-    f1, f2 = fig.ax2.get_ylim()
-    for mid in mid_lst:
-        f = csec_lst[mid-csec_i1]
-        fig.ax2.plot([mid, mid], [f*(f2/f1)**0.01, f*(f2/f1)**0.03], 'k-', lw=0.6,
-                alpha=1)
+    if fig is not None:
+        f1, f2 = fig.ax2.get_ylim()
+        # short ticks above the stacked cross-section, drawn as a single
+        # line collection
+        k1, k2 = (f2/f1)**0.01, (f2/f1)**0.03
+        mids = np.array(mid_lst, dtype=np.int64)
+        fvals = csec_lst[mids-csec_i1]
+        fig.ax2.vlines(mids, fvals*k1, fvals*k2, colors='k', lw=0.6, alpha=1)
         if plot_paper_fig:
-            ax2p.plot([mid, mid], [f*(f2/f1)**0.01, f*(f2/f1)**0.03], 'k-', alpha=1, lw=1)
+            ax2p.vlines(mids, fvals*k1, fvals*k2, colors='k', alpha=1, lw=1)
 
 
     aperture_set = ApertureSet(shape=(h,w))
 
-    # generate a 2-D mesh grid
-    yy, xx = np.mgrid[:h:,:w:]
-
+    # column indices used to gather the pixels of apertures
+    cols = np.arange(w)
+
+    # mean profiles of the columns around every scanned column. they are
+    # shared by all apertures when searching for the local peaks
+    profile_lst = {}
+
+    # the chains of column-to-column transformations do not depend on the
+    # apertures. propagate the central positions of all apertures through
+    # them at once, and find the search windows along every scanned column
+    mid_arr = np.array(mid_lst, dtype=np.float64)
+    ystep_lst, valid_lst, y1_lst, y2_lst = {}, {}, {}, {}
+    for direction in [-1,1]:
+        xcols = np.array(x_lst[direction], dtype=np.int64)[:,np.newaxis]
+        ysteps = np.empty((xcols.size, mid_arr.size))
+        ystep = mid_arr
+        for ix, param in enumerate(param_lst[direction]):
+            ystep = forward(ystep, param)
+            ysteps[ix] = ystep
+        # order centers out of CCD boundaries
+        valid = (ysteps >= 0)*(ysteps <= h-1)
+        # positions out of boundaries are replaced to keep the indices valid
+        ysafe = np.where(valid, ysteps, 0)
+        iy = np.int64(np.round(ysafe))
+        valid *= (bad_mask[iy, xcols] == 0)*(gap_mask[iy, xcols] == 0)
+        local_sep = np.float64(fsep(ysafe))
+        y1 = np.maximum(0, (ysafe - local_sep/2).astype(np.int64))
+        y2 = np.minimum(h, (ysafe + local_sep/2).astype(np.int64))
+        ystep_lst[direction] = ysteps
+        valid_lst[direction] = valid
+        y1_lst[direction] = y1
+        y2_lst[direction] = y2
+
+    # maximum number of nodes of an aperture. the nodes are filled into
+    # preallocated arrays, and n is the number of filled nodes
+    max_nodes = 1 + len(x_lst[-1]) + len(x_lst[1])
+
+    xfit_lst, yfit_lst, domain_lst = [], [], []
     for aperture, mid in enumerate(mid_lst):
-        xfit, yfit = [x0], [mid]
+        xfit = np.empty(max_nodes, dtype=np.int64)
+        yfit = np.empty(max_nodes, dtype=np.float64)
+        xfit[0], yfit[0] = x0, mid
+        n = 1
         for direction in [-1,1]:
-            ystep = mid
-            for ix, param in enumerate(param_lst[direction]):
-                ystep = forward(ystep, param)
-                if ystep < 0 or ystep > h-1:
-                    # order center out of CCD boundaries
+            for ix, x1 in enumerate(x_lst[direction]):
+                if not valid_lst[direction][ix, aperture]:
                     continue
-                x1 = x_lst[direction][ix]
                 y_lst = nodes_lst[x1]
                 # now ystep is the calculated approximate position of peak along
                 # column x1
-                if bad_mask[int(np.round(ystep)), x1] > 0 \
-                    or gap_mask[int(np.round(ystep)), x1] > 0:
-                    continue
+                ystep = ystep_lst[direction][ix, aperture]
                 option = 2
                 # option 1: use (x1, ystep)
                 # option 2: find peak by parabola fitting of the 3 points near
                 #           the maximum pixel
                 # option 3: use the closet point in y_lst as nodes
                 if option == 1:
-                    xfit.append(x1)
-                    yfit.append(ystep)
+                    xfit[n], yfit[n] = x1, ystep
+                    n += 1
                 elif option == 2:
-                    local_sep = fsep(ystep)
-                    y1 = int(ystep-local_sep/2)
-                    y2 = int(ystep+local_sep/2)
-                    y1 = max(0, y1)
-                    y2 = min(h, y2)
+                    y1 = y1_lst[direction][ix, aperture]
+                    y2 = y2_lst[direction][ix, aperture]
                     if y2 - y1 <= 5:
                         # number of points is not enough to get a local peak
                         continue
-                    xdata = np.arange(y1, y2)
-                    ydata = logdata[y1:y2, x1-3:x1+2].mean(axis=1)
+                    # a view of the pixel coordinates, no new array is made
+                    xdata = yarr[y1:y2]
+                    if x1 not in profile_lst:
+                        profile_lst[x1] = logdata[:, x1-3:x1+2].mean(axis=1)
+                    ydata = profile_lst[x1][y1:y2]
                     m = sat_mask[y1:y2, x1]
                     #ypeak = find_local_peak(xdata, ydata, m, smooth=15, figname='%02d.%04d.png'%(aperture, x1))
                     ypeak = find_local_peak(xdata, ydata, m, smooth=15)
-                    xfit.append(x1)
-                    yfit.append(ypeak)
+                    xfit[n], yfit[n] = x1, ypeak
+                    n += 1
                 elif option == 3:
                     diff = np.abs(y_lst - ystep)
                     dmin = diff.min()
                     imin = diff.argmin()
                     if dmin < 2:
-                        xfit.append(x1)
-                        yfit.append(y_lst[imin])
+                        xfit[n], yfit[n] = x1, y_lst[imin]
+                        n += 1
                 else:
-                    xfit.append(x1)
-                    yfit.append(ystep)
+                    xfit[n], yfit[n] = x1, ystep
+                    n += 1
 
         # sort xfit and yfit
-        xfit, yfit = np.array(xfit), np.array(yfit)
+        xfit, yfit = xfit[:n], yfit[:n]
         argsort = xfit.argsort()
         xfit, yfit = xfit[argsort], yfit[argsort]
-        fig.ax1.plot(xfit, yfit, 'ro',lw=0.5, alpha=0.8, ms=1, markeredgewidth=0)
+        if fig is not None:
+            fig.ax1.plot(xfit, yfit, 'ro', lw=0.5, alpha=0.8, ms=1,
+                         markeredgewidth=0)
 
         # fit chebyshev polynomial
         # determine the left and right domain
@@ -1262,106 +1562,98 @@ def find_apertures(data, mask, scan_step=50, minimum=1e-3, separation=20,
 
         domain = (left_domain, right_domain)
 
-        poly = Chebyshev.fit(xfit, yfit, domain=domain, deg=3)
+        xfit_lst.append(xfit)
+        yfit_lst.append(yfit)
+        domain_lst.append(domain)
 
-        # generate a curve using for plot
-        newx, newy = poly.linspace()
-        fig.ax1.plot(newx, newy, '-',lw=0.8, alpha=1, color='C0')
-
-        if plot_paper_fig:
-            # plot the order in paper figure and the mini-figure
-            ax1p.plot(newx, newy, '-',lw=0.7, alpha=1, color='C0')
-            ax1m.plot(newx, newy, '-',lw=1.0, alpha=1, color='C0')
+    # fit chebyshev polynomials of all apertures at once
+    poly_lst = _chebfit_batch(xfit_lst, yfit_lst, domain_lst, deg=3)
 
+    for aperture, poly in enumerate(poly_lst):
         # initialize aperture position instance
         aperture_loc = ApertureLocation(direct='x', shape=(h,w))
         aperture_loc.set_position(poly)
+        aperture_set[aperture] = aperture_loc
+
+    # generate the curves used to find saturation pixels of all apertures in
+    # a single batched evaluation
+    center_line_lst = aperture_set.get_positions(np.arange(w))
+
+    # flattened views of the image and the saturation mask for the gathers
+    # below. np.take on a non-contiguous array would make a full copy of it
+    # for every aperture, so the copy (if any) is made only once here
+    data_flat = data.ravel()
+    sat_flat  = sat_mask.ravel()
 
-        # generate a curve using for find saturation pixels
-        center_line = aperture_loc.position(np.arange(w))
+    for aperture, aperture_loc in aperture_set.sorted_items():
+        if fig is not None or plot_paper_fig:
+            # generate a curve using for plot
+            newx, newy = aperture_loc.position.linspace()
+            if fig is not None:
+                fig.ax1.plot(newx, newy, '-',lw=0.8, alpha=1, color='C0')
+
+            if plot_paper_fig:
+                # plot the order in paper figure and the mini-figure
+                ax1p.plot(newx, newy, '-',lw=0.7, alpha=1, color='C0')
+                ax1m.plot(newx, newy, '-',lw=1.0, alpha=1, color='C0')
+
+        center_line = center_line_lst[aperture]
 
         # find approximate lower and upper boundaries of this order
         lower_bound = center_line - 3
         upper_bound = center_line + 3
 
-        aperture_mask = (yy > lower_bound)*(yy < upper_bound)
-        # find saturation mask
-        aperture_sat = (np.int16(sat_mask)*aperture_mask).sum(axis=0)
+        # the pixels between the boundaries span at most 6 rows in every
+        # column. gather them instead of masking the whole image
+        rows = np.floor(lower_bound).astype(np.int64) \
+                + np.arange(1, 7)[:,np.newaxis]
+        aperture_mask = (rows < upper_bound)*(rows >= 0)*(rows < h)
+        # flattened pixel indices shared by the data and saturation gathers
+        idx = np.clip(rows, 0, h-1)*w + cols
         # find 1d mask of saturation pixels for this aperture
-        sat_mask_1d = aperture_sat > 0
+        sat_mask_1d = (sat_flat[idx] & aperture_mask).any(axis=0)
         # find how many saturated pixels in this aperture
         nsat = sat_mask_1d.sum()
         aperture_loc.nsat = nsat
 
-        # get peak flux for this flat
-        peak_flux = (data*aperture_mask).max(axis=0)
+        # get peak flux for this flat. pixels outside the aperture count as
+        # zeros
+        peak_flux = np.where(aperture_mask, data_flat[idx], 0).max(axis=0,
+                                                                   initial=0)
 
         aperture_loc.mean   = peak_flux.mean()
         aperture_loc.median = np.median(peak_flux)
         aperture_loc.max    = peak_flux.max()
 
-        aperture_set[aperture] = aperture_loc
-
     # plot the order separation information in ax4
-    center_lst = [aper_loc.get_center()
-                  for aper, aper_loc in sorted(aperture_set.items())]
-    fig.ax4.plot(center_lst, derivative(center_lst), 'ko', alpha=0.2, zorder=-1)
-    newx = np.arange(h)
-    fig.ax4.plot(newx, fsep(newx), 'k--', alpha=0.2, zorder=-1)
-    fig.ax4.set_xlim(0, h-1)
-    for tickline in fig.ax4.yaxis.get_ticklines():
-        tickline.set_color('gray')
-        tickline.set_alpha(0.8)
-    for tick in fig.ax4.yaxis.get_major_ticks():
-        tick.label2.set_color('gray')
-        tick.label2.set_alpha(0.8)
-    fig.ax3.set_xlabel('Y', fontsize=12)
-    fig.ax3.set_ylabel('Detected Peaks', fontsize=12)
-    fig.ax4.set_ylabel('Order Separation (Pixel)', color='gray', alpha=0.8,
-                    fontsize=12)
-    for ax in [fig.ax2, fig.ax3, fig.ax4]:
-        ax.set_xlim(csec_ylst[istart], csec_ylst[iend])
-        # set tickers
-        ax.xaxis.set_major_locator(tck.MultipleLocator(500))
-        ax.xaxis.set_minor_locator(tck.MultipleLocator(100))
-
-    fig.canvas.draw()
-    
+    if fig is not None:
+        center_lst = aperture_set.centers_array()
+        fig.ax4.plot(center_lst, derivative(center_lst), 'ko', alpha=0.2,
+                     zorder=-1)
+        newx = np.arange(h)
+        fig.ax4.plot(newx, fsep(newx), 'k--', alpha=0.2, zorder=-1)
+        fig.ax4.set_xlim(0, h-1)
+        for tickline in fig.ax4.yaxis.get_ticklines():
+            tickline.set_color('gray')
+            tickline.set_alpha(0.8)
+        for tick in fig.ax4.yaxis.get_major_ticks():
+            tick.label2.set_color('gray')
+            tick.label2.set_alpha(0.8)
+        fig.ax3.set_xlabel('Y', fontsize=12)
+        fig.ax3.set_ylabel('Detected Peaks', fontsize=12)
+        fig.ax4.set_ylabel('Order Separation (Pixel)', color='gray', alpha=0.8,
+                        fontsize=12)
+        for ax in [fig.ax2, fig.ax3, fig.ax4]:
+            ax.set_xlim(csec_ylst[istart], csec_ylst[iend])
+            # set tickers
+            ax.xaxis.set_major_locator(tck.MultipleLocator(500))
+            ax.xaxis.set_minor_locator(tck.MultipleLocator(100))
+
+        fig.canvas.draw()
+
     if plot_paper_fig:
-        # adjust figure 1 in paper
-        ax1p.xaxis.set_major_locator(tck.MultipleLocator(500))
-        ax1p.xaxis.set_minor_locator(tck.MultipleLocator(100))
-        ax1p.yaxis.set_major_locator(tck.MultipleLocator(500))
-        ax1p.yaxis.set_minor_locator(tck.MultipleLocator(100))
-        for tick in ax1p.xaxis.get_major_ticks():
-            tick.label1.set_fontsize(13)
-        for tick in ax1p.yaxis.get_major_ticks():
-            tick.label1.set_fontsize(13)
-        ax1p.set_xlim(0,w-1)
-        ax1p.set_ylim(h-1,0)
-        ax1p.set_xlabel('X', fontsize=18)
-        ax1p.set_ylabel('Y', fontsize=18)
-        ax1m.set_xlim(1600, w-1)
-        ax1m.set_ylim(h-1, 1600)
-        ax1m.set_xticks([])
-        ax1m.set_yticks([])
-        figfile='testaaa'
-        fig1p.savefig(figfile+'.pdf')
-
-        # adjust figure 2 in paper
-        ax2p.xaxis.set_major_locator(tck.MultipleLocator(500))
-        ax2p.xaxis.set_minor_locator(tck.MultipleLocator(100))
-        for tick in ax2p.xaxis.get_major_ticks():
-            tick.label1.set_fontsize(13)
-        for tick in ax2p.yaxis.get_major_ticks():
-            tick.label1.set_fontsize(13)
-        ax2p.set_yscale('log')
-        ax2p.set_xlabel('Y', fontsize=18)
-        ax2p.set_ylabel('Count', fontsize=18)
-        ax2p.set_xlim(csec_ylst[istart], csec_ylst[iend])
-        fig2p.savefig(figfile+'_2.pdf')
-        plt.close(fig1p)
-        plt.close(fig2p)
+        _save_paper_figures(fig1p, ax1p, ax1m, fig2p, ax2p, h, w,
+                            (csec_ylst[istart], csec_ylst[iend]))
 
     # for debug purpose
     #fig.ax2.set_xlim(3400, 3500)
@@ -1381,11 +1673,10 @@ def load_aperture_set(filename):
         :class:`ApertureSet`: An :class:`ApertureSet` instance.
     """
 
-    aperture_set = ApertureSet()
-
     magic = 'APERTURE LOCATION'
 
-    # read input file
+    # read input file and collect the parameters of every aperture
+    param_lst = {}
     infile = open(filename)
     aperture = None
     for row in infile:
@@ -1394,25 +1685,49 @@ def load_aperture_set(filename):
             continue
         elif len(row)>len(magic) and row[0:len(magic)]==magic:
             aperture = int(row[len(magic):])
-            aperture_set[aperture] = ApertureLocation()
+            param_lst[aperture] = {}
         elif aperture is not None and '=' in row:
             g = row.split('=')
             key   = g[0].strip()
             value = g[1].strip()
-            if key == 'position':
-                value = eval(value)
-                aperture_loc = aperture_set[aperture]
-                n = aperture_loc.shape[aperture_loc.direct]
-                poly = Chebyshev(coef=value, domain=[0, n-1])
-                aperture_loc.set_position(poly)
-            elif key == 'domain':
-                aperture_loc.position.domain = eval(value)
-            else:
-                setattr(aperture_set[aperture], key, eval(value))
+            param_lst[aperture][key] = ast.literal_eval(value)
     infile.close()
 
+    # build the aperture locations. the position polynomial is constructed
+    # only once with its final domain
+    aperture_set = ApertureSet()
+    for aperture, param in param_lst.items():
+        aperture_loc = ApertureLocation()
+        coef   = param.pop('position', None)
+        domain = param.pop('domain', None)
+        for key, value in param.items():
+            if key.startswith('nodes_'):
+                # nodes are kept as a tuple of (xnodes, ynodes) arrays
+                value = tuple(np.array(value).T)
+            setattr(aperture_loc, key, value)
+        if coef is not None:
+            if domain is None:
+                n = aperture_loc.shape[aperture_loc.direct]
+                domain = [0, n-1]
+            aperture_loc.set_position(Chebyshev(coef=coef, domain=domain))
+        aperture_set[aperture] = aperture_loc
+
     return aperture_set
 
+# names of the aperture parameters for the scalar keywords written by
+# ApertureSet.to_fitsheader
+_trace_header_keys = {
+    'DIRECT':  'direct',
+    'SHAPE0':  'shape0',
+    'SHAPE1':  'shape1',
+    'DOMAIN0': 'domain0',
+    'DOMAIN1': 'domain1',
+    'NSAT':    'nsat',
+    'MEAN':    'mean',
+    'MEDIAN':  'median',
+    'MAX':     'max',
+    }
+
 def load_aperture_set_from_header(header, fiber=None, channel=None):
     """Load Aperture Set from FITS header.
 
@@ -1433,68 +1748,34 @@ def load_aperture_set_from_header(header, fiber=None, channel=None):
     if channel is not None:
         prefix += ' CHANNEL '+channel
     
-    aperture_set = ApertureSet()
-    coeff = []
-    prev_aper = None
-    has_aperture = False
+    # collect the parameters of every aperture
+    plen = len(prefix)
+    param_lst = {}
     for key, value in header.items():
-        if key[0:len(prefix)] == prefix:
-            has_aperture = True
-            g = key[len(prefix):].strip().split()
-            aperture = int(g[1])
-            if prev_aper is not None and aperture != prev_aper:
-                # at the end of aperture
-                aperture_set[prev_aper] = ApertureLocation(
-                                            direct = direct,
-                                            shape  = shape,
-                                            )
-                poly = Chebyshev(coef=coeff, domain=domain)
-                aperture_set[prev_aper].set_position(poly)
-                aperture_set[prev_aper].nsat   = nsat
-                aperture_set[prev_aper].mean   = mean
-                aperture_set[prev_aper].median = median
-                aperture_set[prev_aper].max    = maxv
-                # reset parameters
-                coeff = []
-            if g[2] == 'COEFF':
-                coeff.append(value)
-            elif g[2] == 'DIRECT':
-                direct = value
-            elif g[2] == 'SHAPE':
-                shape = eval(value)
-            elif g[2] == 'SHAPE0':
-                shape0 = value
-            elif g[2] == 'SHAPE1':
-                shape1 = value
-                shape = (shape0, shape1)
-            elif g[2] == 'DOMAIN':
-                domain = eval(value)
-            elif g[2] == 'DOMAIN0':
-                domain0 = value
-            elif g[2] == 'DOMAIN1':
-                domain1 = value
-                domain = (domain0, domain1)
-            elif g[2] == 'NSAT':
-                nsat = value
-            elif g[2] == 'MEAN':
-                mean = value
-            elif g[2] == 'MEDIAN':
-                median = value
-            elif g[2] == 'MAX':
-                maxv = value
-            else:
-                pass
-            prev_aper = aperture
-
-    # pack the last aperture
-    if has_aperture:
-        aperture_set[aperture] = ApertureLocation(direct=direct, shape=shape)
-        poly = Chebyshev(coef=coeff, domain=domain)
-        aperture_set[aperture].set_position(poly)
-        aperture_set[prev_aper].nsat   = nsat
-        aperture_set[prev_aper].mean   = mean
-        aperture_set[prev_aper].median = median
-        aperture_set[prev_aper].max    = maxv
+        if not key.startswith(prefix):
+            continue
+        g = key[plen:].split()
+        param = param_lst.setdefault(int(g[1]), {'coeff': []})
+        tag = g[2]
+        if tag == 'COEFF':
+            param['coeff'].append(value)
+        elif tag in ('SHAPE', 'DOMAIN'):
+            param[tag.lower()] = ast.literal_eval(value)
+        elif tag in _trace_header_keys:
+            param[_trace_header_keys[tag]] = value
+
+    # build the aperture locations
+    aperture_set = ApertureSet()
+    for aperture, param in param_lst.items():
+        shape = param.get('shape', (param.get('shape0'), param.get('shape1')))
+        domain = param.get('domain',
+                    (param.get('domain0'), param.get('domain1')))
+        aperture_loc = ApertureLocation(direct=param['direct'], shape=shape)
+        aperture_loc.set_position(Chebyshev(coef=param['coeff'], domain=domain))
+        for attr in ('nsat', 'mean', 'median', 'max'):
+            if attr in param:
+                setattr(aperture_loc, attr, param[attr])
+        aperture_set[aperture] = aperture_loc
 
     return aperture_set
 
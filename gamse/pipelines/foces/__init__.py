@@ -1,5 +1,6 @@
 import os
 import re
+import concurrent.futures
 import datetime
 import configparser
 
@@ -131,19 +132,164 @@ def make_config():
 
     # write to config file
     filename = 'FOCES.{}.cfg'.format(input_date)
-    outfile = open(filename, 'w')
+    # collect all lines and write them at once
+    line_lst = []
     for section in config.sections():
         maxkeylen = max([len(key) for key in config[section].keys()])
-        outfile.write('[{}]'.format(section)+os.linesep)
+        line_lst.append('[{}]'.format(section))
         fmt = '{{:{}s}} = {{}}'.format(maxkeylen)
         for key, value in config[section].items():
-            outfile.write(fmt.format(key, value)+os.linesep)
-        outfile.write(os.linesep)
+            line_lst.append(fmt.format(key, value))
+        line_lst.append('')
+    outfile = open(filename, 'w')
+    outfile.write(os.linesep.join(line_lst)+os.linesep)
     outfile.close()
 
     print('Config file written to {}'.format(filename))
 
-def make_obslog(path):
+# standard naming convenctions for fileid
+_name_pattern1 = re.compile(r'^\d{8}_\d{4}_FOC\d{4}_[A-Za-z0-9]{4}$')
+_name_pattern2 = re.compile(r'^fcs_\d{14}$')
+
+# image types and objects in the two fibers for the frame codes in the
+# standard fileids. the codes are characters 22-26 (or 22-25) of fileid, and
+# None is replaced by the target name
+_frame_code_lst = {
+    'BIA':  ('cal', ['Bias']),
+    'FLS':  ('cal', ['Flat', '']),
+    'FLC':  ('cal', ['', 'Flat']),
+    'COCS': ('cal', ['Comb', 'Comb']),
+    'COC0': ('cal', ['', 'Comb']),
+    'COS0': ('cal', ['Comb', '']),
+    'THS':  ('cal', ['ThAr', 'ThAr']),
+    'THC':  ('cal', ['', 'ThAr']),
+    'SCI0': ('sci', [None, '']),
+    'SCC2': ('sci', [None, 'Comb']),
+    'SCT2': ('sci', [None, 'ThAr']),
+    }
+
+def get_frame_stats(data, saturation_level):
+    """Get the number of saturated pixels and the 95% quantile of a frame.
+
+    For 8 or 16-bit unsigned integer images, both values are read from a
+    histogram of the pixel values, so the frame is only traversed once.
+
+    Args:
+        data (:class:`numpy.ndarray`): Image data.
+        saturation_level (int): Minimum value of saturated pixels.
+
+    Returns:
+        tuple: A tuple containing:
+
+            * **saturation** (*int*): Number of saturated pixels.
+            * **quantile95** (*int*): 95% quantile of the pixel values,
+              rounded to integer.
+
+    """
+    if data.dtype.kind == 'u' and data.dtype.itemsize <= 2:
+        hist = np.bincount(data.ravel(), minlength=saturation_level+1)
+        saturation = int(hist[saturation_level:].sum())
+        # interpolate linearly between the two order statistics around the
+        # quantile, as np.percentile does. the i-th smallest value (starting
+        # from 0) is the first value with more than i pixels up to it
+        cumhist = hist.cumsum()
+        pos = 0.95*(data.size-1)
+        i = int(pos)
+        v1 = np.searchsorted(cumhist, i+1)
+        v2 = np.searchsorted(cumhist, min(i+2, data.size))
+        quantile95 = int(np.round(v1 + (pos-i)*(v2-v1)))
+    else:
+        saturation = int((data>=saturation_level).sum())
+        quantile95 = int(np.round(np.percentile(data, 95)))
+    return saturation, quantile95
+
+def _scan_one(args):
+    """Read the header (and optionally the pixel data) of a FOCES raw frame.
+
+    Args:
+        args (tuple): A tuple of (*path*, *fname*, *with_stats*), where
+            *path* is the path to the raw FITS files, *fname* is the name of
+            the file, and *with_stats* is the same as in :func:`make_obslog`.
+
+    Returns:
+        tuple: A tuple containing:
+
+            * **frameid** (*int* or *None*) – Frame ID. *None* if the fileid
+              does not contain a frame number but frames are numbered
+              consecutively.
+            * **has_frameid** (*bool*) – Whether the fileid follows one of
+              the naming conventions.
+            * **fileid** (*str*) – File ID.
+            * **imgtype** (*str*) – Image type.
+            * **objectname** (*str*) – Formatted object names in the fibers.
+            * **exptime** (*float*) – Exposure time.
+            * **obsdate** (:class:`astropy.time.Time`) – Observing time.
+            * **saturation** (*int*) – Number of saturated pixels.
+            * **quantile95** (*int*) – 95% quantile of the pixel values.
+
+    See also:
+        :func:`make_obslog`
+    """
+    path, fname, with_stats = args
+
+    fileid = fname[0:-5]
+    filename = os.path.join(path, fname)
+    # the pixel data of the HDU are loaded lazily (and memory-mapped if
+    # not scaled by BZERO/BSCALE), so they are only read if the
+    # statistics are required
+    hdulst = fits.open(filename)
+    head = hdulst[0].header
+
+    obsdate = Time(head['FRAME'])
+    exptime = head['EXPOSURE']
+    target  = 'Unknown'
+    if 'PROJECT' in head: target = str(head['PROJECT'])[:10]
+    if 'OBJECT'  in head: target = str(head['OBJECT'])[:10]
+
+    if _name_pattern1.match(fileid):
+        # fileid matches the standard FOCES naming convention
+        code = fileid[22:26]
+        if code not in _frame_code_lst:
+            code = fileid[22:25]
+        imgtype, object_lst = _frame_code_lst.get(code, ('cal', ['', '']))
+        object_lst = [target if obj is None else obj for obj in object_lst]
+
+        frameid = int(fileid[9:13])
+        has_frameid = True
+    elif _name_pattern2.match(fileid):
+        # frameid is allocated by the caller
+        frameid = None
+        imgtype = 'cal'
+        object_lst = ['', '']
+        has_frameid = True
+    else:
+        # fileid does not follow the naming convetion
+        imgtype = 'cal'
+        object_lst = ['', '']
+        frameid = 0
+        has_frameid = False
+
+    if len(object_lst)==1:
+        objectname = '{:^21s}'.format(object_lst[0])
+    elif len(object_lst)==2:
+        objectname = '|'.join(['{:^10s}'.format(v) for v in object_lst])
+    else:
+        print('Warning: length of object_lst ({}) excess the maximum number'
+              'of fibers (2)'.format(len(object_lst)))
+        objectname = '{:^21s}'.format('Error')
+        pass
+
+    # determine the total number of saturated pixels and the 95% quantile
+    if with_stats:
+        saturation, quantile95 = get_frame_stats(hdulst[0].data, 63000)
+    else:
+        saturation, quantile95 = -1, -1
+    hdulst.close()
+
+    return (frameid, has_frameid, fileid, imgtype, objectname, exptime,
+            obsdate, saturation, quantile95)
+
+def make_obslog(path, with_stats=True, nproc=None):
     """Scan the raw data, and generated a log file containing the detail
     information for each frame.
 
@@ -152,12 +298,13 @@ def make_obslog(path):
 
     Args:
         path (str): Path to the raw FITS files.
+        with_stats (bool): Whether to read the pixel data and compute the
+            number of saturated pixels and the 95% quantile of each frame. If
+            *False*, only the FITS headers are read and both values are -1.
+        nproc (int): Number of processes used to read the files. If *None*,
+            the number of CPUs is used.
 
     """
-    
-    # standard naming convenction for fileid
-    name_pattern1 = '^\d{8}_\d{4}_FOC\d{4}_[A-Za-z0-9]{4}$'
-    name_pattern2 = '^fcs_\d{14}$'
 
     fname_lst = sorted(os.listdir(path))
 
@@ -187,108 +334,34 @@ def make_obslog(path):
     #print(pinfo.get_dtype())
     print(pinfo.get_separator())
 
-    # start scanning the raw files
-    prev_frameid = 0
-    for fname in fname_lst:
-        if fname[-5:] != '.fits':
-            continue
-        fileid = fname[0:-5]
-        filename = os.path.join(path, fname)
-        data, head = fits.getdata(filename, header=True)
-
-        # old FOCES data are 3-dimensional arrays
-        if data.ndim == 3:
-            scidata = data[0, 20:-20]
-        else:
-            scidata = data[:,20:-20]
-            
-        obsdate = Time(head['FRAME'])
-        exptime = head['EXPOSURE']
-        target  = 'Unknown'
-        if 'PROJECT' in head: target = str(head['PROJECT'])[:10]
-        if 'OBJECT'  in head: target = str(head['OBJECT'])[:10]
-
-        if re.match(name_pattern1, fileid):
-            # fileid matches the standard FOCES naming convention
-            if fileid[22:25]=='BIA':
-                imgtype = 'cal'
-                object_lst = ['Bias']
-            elif fileid[22:25]=='FLS':
-                imgtype = 'cal'
-                object_lst = ['Flat', '']
-            elif fileid[22:25]=='FLC':
-                imgtype = 'cal'
-                object_lst = ['', 'Flat']
-            elif fileid[22:26]=='COCS':
-                imgtype = 'cal'
-                object_lst = ['Comb', 'Comb']
-            elif fileid[22:26]=='COC0':
-                imgtype = 'cal'
-                object_lst = ['', 'Comb']
-            elif fileid[22:26]=='COS0':
-                imgtype = 'cal'
-                object_lst = ['Comb', '']
-            elif fileid[22:25]=='THS':
-                imgtype = 'cal'
-                object_lst = ['ThAr', 'ThAr']
-            elif fileid[22:25]=='THC':
-                imgtype  = 'cal'
-                object_lst = ['', 'ThAr']
-            elif fileid[22:25]=='THS':
-                imgtype  = 'cal'
-                object_lst = ['ThAr', '']
-            elif fileid[22:26]=='SCI0':
-                imgtype  = 'sci'
-                object_lst = [target, '']
-            elif fileid[22:26]=='SCC2':
-                imgtype  = 'sci'
-                object_lst = [target, 'Comb']
-            elif fileid[22:26]=='SCT2':
-                imgtype  = 'sci'
-                object_lst = [target, 'ThAr']
-  
-            frameid = int(fileid[9:13])
-            has_frameid = True
-        elif re.match(name_pattern2, fileid):
-            frameid = prev_frameid + 1
-            imgtype = 'cal'
-            object_lst = ['', '']
-            has_frameid = True
-        else:
-            # fileid does not follow the naming convetion
-            imgtype = 'cal'
-            object_lst = ['', '']
-            frameid = 0
-            has_frameid = False
-
-        if len(object_lst)==1:
-            objectname = '{:^21s}'.format(object_lst[0])
-        elif len(object_lst)==2:
-            objectname = '|'.join(['{:^10s}'.format(v) for v in object_lst])
-        else:
-            print('Warning: length of object_lst ({}) excess the maximum number'
-                  'of fibers (2)'.format(len(object_lst)))
-            objectname = '{:^21s}'.format('Error')
-            pass
+    # start scanning the raw files. the files are read by a pool of
+    # processes, and executor.map() returns the results in the same order as
+    # fname_lst
+    arg_lst = [(path, fname, with_stats) for fname in fname_lst
+                if fname[-5:] == '.fits']
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nproc) as executor:
+        result_lst = executor.map(_scan_one, arg_lst, chunksize=8)
+
+        prev_frameid = 0
+        for result in result_lst:
+            (frameid, has_frameid, fileid, imgtype, objectname, exptime,
+                obsdate, saturation, quantile95) = result
+
+            if frameid is None:
+                # fileid without frame number. use the next one
+                frameid = prev_frameid + 1
+
+            item = [frameid, fileid, imgtype, objectname, exptime, obsdate,
+                    saturation, quantile95]
+            logtable.add_row(item)
+            # get table Row object. (not elegant!)
+            item = logtable[-1]
+
+            # print log item with colors
+            string = pinfo.get_format(has_esc=False).format(item)
+            print(print_wrapper(string, item))
 
-        # determine the total number of saturated pixels
-        saturation = (data>=63000).sum()
-
-        # find the 95% quantile
-        #quantile95 = np.sort(data.flatten())[int(data.size*0.95)]
-        quantile95 = int(np.round(np.percentile(data, 95)))
-
-        item = [frameid, fileid, imgtype, objectname, exptime, obsdate,
-                saturation, quantile95]
-        logtable.add_row(item)
-        # get table Row object. (not elegant!)
-        item = logtable[-1]
-
-        # print log item with colors
-        string = pinfo.get_format(has_esc=False).format(item)
-        print(print_wrapper(string, item))
-
-        prev_frameid = frameid
+            prev_frameid = frameid
 
     print(pinfo.get_separator())
 
@@ -319,13 +392,13 @@ def make_obslog(path):
 
     # save the logtable
     loginfo = FormattedInfo(obslog_columns)
-    outfile = open(outfilename, 'w')
-    outfile.write(loginfo.get_title(delimiter='|')+os.linesep)
-    outfile.write(loginfo.get_dtype(delimiter='|')+os.linesep)
-    outfile.write(loginfo.get_separator(delimiter='+')+os.linesep)
     fmt_string = loginfo.get_format(has_esc=False, delimiter='|')
-    for row in logtable:
-        outfile.write(fmt_string.format(row)+os.linesep)
+    line_lst = [loginfo.get_title(delimiter='|'),
+                loginfo.get_dtype(delimiter='|'),
+                loginfo.get_separator(delimiter='+')]
+    line_lst.extend([fmt_string.format(row) for row in logtable])
+    outfile = open(outfilename, 'w')
+    outfile.write(os.linesep.join(line_lst)+os.linesep)
     outfile.close()
 
 
@@ -1,5 +1,7 @@
+import io
 import os
 import re
+import concurrent.futures
 import logging
 logger = logging.getLogger(__name__)
 
@@ -35,6 +37,101 @@ from .common import (obslog_columns, print_wrapper, get_mask,
 from .flat import (smooth_aperpar_A, smooth_aperpar_k, smooth_aperpar_c,
                    smooth_aperpar_bkg)
 
+def _load_combined_flat(filename, exptime_key):
+    """Load a combined flat written by :func:`reduce_doublefiber`.
+
+    Args:
+        filename (str): Filename of the combined flat.
+        exptime_key (str): Keyword of the exposure time in FITS header.
+
+    Returns:
+        tuple: A tuple containing the flat data, mask, exposure time
+            normalized flat, sensitivity map, 1-D spectra, and the exposure
+            time.
+
+    """
+    with fits.open(filename) as hdu_lst:
+        flat_data = hdu_lst[0].data
+        flat_mask = hdu_lst[1].data
+        flat_norm = hdu_lst[2].data
+        flat_sens = hdu_lst[3].data
+        flat_spec = hdu_lst[4].data
+        exptime   = hdu_lst[0].header[exptime_key]
+    return flat_data, flat_mask, flat_norm, flat_sens, flat_spec, exptime
+
+def _bulk_writeto(hdu_lst, filename):
+    """Write an HDU list to a FITS file with a single write call.
+
+    The FITS file is first written into an in-memory buffer, which avoids
+    the many small writes of :meth:`astropy.io.fits.HDUList.writeto` on
+    network filesystems. Existing file will be overwritten.
+
+    Args:
+        hdu_lst (:class:`astropy.io.fits.HDUList`): HDU list to write.
+        filename (str): Name of the output FITS file.
+
+    """
+    buf = io.BytesIO()
+    hdu_lst.writeto(buf)
+    with open(filename, 'wb') as outfile:
+        outfile.write(buf.getbuffer())
+
+# bias and keyword of exposure time shared by the processes that correct the
+# flat frames
+_flat_worker_bias = None
+_flat_worker_exptime_key = None
+
+def _init_flat_worker(bias, exptime_key):
+    """Initialize a process that corrects flat frames.
+
+    Args:
+        bias (:class:`numpy.ndarray`): Bias image, or *None*.
+        exptime_key (str): Keyword of the exposure time in FITS header.
+
+    """
+    global _flat_worker_bias, _flat_worker_exptime_key
+    _flat_worker_bias = bias
+    _flat_worker_exptime_key = exptime_key
+
+def _prep_flat_frame(filename):
+    """Read a raw flat frame and correct its overscan and bias.
+
+    Args:
+        filename (str): Filename of the raw flat frame.
+
+    Returns:
+        tuple: A tuple containing:
+
+            * **data** (:class:`numpy.ndarray`) – Corrected image.
+            * **exptime** (*float*) – Exposure time.
+            * **sat_mask** (:class:`numpy.ndarray`) – Mask of saturated
+              pixels.
+            * **bad_mask** (:class:`numpy.ndarray`) – Mask of bad pixels.
+            * **overmean** (*float*) – Mean value of overscan pixels.
+
+    See also:
+        :func:`_init_flat_worker`
+    """
+    data, head = fits.getdata(filename, header=True)
+    exptime = head[_flat_worker_exptime_key]
+    if data.ndim == 3:
+        data = data[0,:,:]
+    mask = get_mask(data)
+
+    sat_mask = (mask&4>0)
+    bad_mask = (mask&2>0)
+
+    # correct overscan for flat
+    data, card_lst, overmean = correct_overscan(data, mask)
+
+    # correct bias for flat, if has bias
+    # the overscan-corrected data is a new float array, so the bias can be
+    # subtracted in place
+    if _flat_worker_bias is not None:
+        np.subtract(data, _flat_worker_bias, out=data)
+
+    return data, exptime, sat_mask, bad_mask, overmean
+
 def reduce_doublefiber(logtable, config):
     """Data reduction for multiple-fiber configuration.
 
@@ -103,42 +200,42 @@ def reduce_doublefiber(logtable, config):
     #                'B':{'flat_M': [fileid1, fileid2, ...],
     #                     'flat_N': [fileid1, fileid2, ...]}}
 
-    for logitem in logtable:
-        fiberobj_lst = [v.strip() for v in logitem['object'].split('|')]
+    # split the object names of all frames into an array of (nframe, nname),
+    # padded with empty names
+    fiberobj_lst = [[v.strip() for v in obj.split('|')]
+                    for obj in logtable['object']]
+    nname = max([n_fiber] + [len(v) for v in fiberobj_lst])
+    nameflag_lst = [len(v) >= n_fiber for v in fiberobj_lst]
+    name_array = np.array([v + ['']*(nname-len(v)) for v in fiberobj_lst],
+                          dtype=str).reshape(-1, nname)
+
+    # a frame is a single-channel flat if the object name of the channel
+    # matches "flat ???" and the names of other channels are all empty
+    single = (name_array != '').sum(axis=1) == 1
+    single &= np.array(nameflag_lst, dtype=bool)
+    objname_array = np.char.lower(name_array[:, 0:n_fiber])
+    isflat = np.char.startswith(objname_array, 'flat') & single[:, None]
+
+    for irow, ifiber in zip(*np.nonzero(isflat)):
+        logitem = logtable[irow]
+        fiber = chr(ifiber+65)
+        objname = str(objname_array[irow, ifiber]).strip()
 
-        if n_fiber > len(fiberobj_lst):
-            continue
+        # find a proper name (flatname) for this flat
+        if objname=='flat':
+            # no special names given, use exptime
+            flatname = '{[exptime]:g}'.format(logitem)
+        else:
+            # flatname is given. replace space with "_"
+            # remove "flat" before the objectname. e.g.,
+            # "Flat Red" becomes "Red" 
+            char = objname[4:].strip()
+            flatname = char.replace(' ','_')
 
-        for ifiber in range(n_fiber):
-            fiber = chr(ifiber+65)
-            objname = fiberobj_lst[ifiber].lower().strip()
-            if re.match('^flat[\s\S]*', objname):
-                # the object name of the channel matches "flat ???"
-            
-                # check the lengthes of names for other channels
-                # if this list has no elements (only one fiber) or has no
-                # names, this frame is a single-channel flat
-                other_lst = [name for i, name in enumerate(fiberobj_lst)
-                                    if i != ifiber and len(name)>0]
-                if len(other_lst)>0:
-                    # this frame is not a single chanel flat. Skip
-                    continue
-
-                # find a proper name (flatname) for this flat
-                if objname=='flat':
-                    # no special names given, use exptime
-                    flatname = '{[exptime]:g}'.format(logitem)
-                else:
-                    # flatname is given. replace space with "_"
-                    # remove "flat" before the objectname. e.g.,
-                    # "Flat Red" becomes "Red" 
-                    char = objname[4:].strip()
-                    flatname = char.replace(' ','_')
-            
-                # add flatname to flat_groups
-                if flatname not in flat_groups[fiber]:
-                    flat_groups[fiber][flatname] = []
-                flat_groups[fiber][flatname].append(logitem)
+        # add flatname to flat_groups
+        if flatname not in flat_groups[fiber]:
+            flat_groups[fiber][flatname] = []
+        flat_groups[fiber][flatname].append(logitem)
 
     '''
     # print the flat_groups
@@ -176,19 +273,13 @@ def reduce_doublefiber(logtable, config):
             # get flat_data and mask_array for each flat group
             if mode=='debug' and os.path.exists(flat_filename) \
                 and os.path.exists(aperset_filename):
-                # read flat data and mask array
-                hdu_lst = fits.open(flat_filename)
-                flat_data = hdu_lst[0].data
-                flat_mask = hdu_lst[1].data
-                flat_norm = hdu_lst[2].data
-                flat_sens = hdu_lst[3].data
-                flat_spec = hdu_lst[4].data
-                exptime   = hdu_lst[0].header[exptime_key]
-                hdu_lst.close()
+                # read flat data and mask array. they are kept in the flat
+                # dicts below, so the file is read only once
+                (flat_data, flat_mask, flat_norm, flat_sens, flat_spec,
+                    exptime) = _load_combined_flat(flat_filename, exptime_key)
                 aperset = load_aperture_set(aperset_filename)
             else:
                 # if the above conditions are not satisfied, comine each flat
-                data_lst = []
                 head_lst = []
                 exptime_lst = []
 
@@ -197,51 +288,56 @@ def reduce_doublefiber(logtable, config):
                 print(' '*2 + pinfo2.get_title())
                 print(' '*2 + pinfo2.get_separator())
 
-                for i_item, logitem in enumerate(item_lst):
-                    # read each individual flat frame
-                    filename = os.path.join(rawdata, logitem['fileid']+'.fits')
-                    data, head = fits.getdata(filename, header=True)
-                    exptime_lst.append(head[exptime_key])
-                    if data.ndim == 3:
-                        data = data[0,:,:]
-                    mask = get_mask(data)
-
-                    # generate the mask for all images
-                    sat_mask = (mask&4>0)
-                    bad_mask = (mask&2>0)
-                    if i_item == 0:
-                        allmask = np.zeros_like(mask, dtype=np.int16)
-                    allmask += sat_mask
-
-                    # correct overscan for flat
-                    data, card_lst, overmean = correct_overscan(data, mask)
-                    # head['BLANK'] is only valid for integer arrays.
-                    if 'BLANK' in head:
-                        del head['BLANK']
-                    for key, value in card_lst:
-                        head.append((key, value))
-
-                    # correct bias for flat, if has bias
-                    if bias is None:
-                        message = 'No bias. skipped bias correction'
-                    else:
-                        data = data - bias
-                        message = 'Bias corrected'
-                    logger.info(message)
+                # read and correct the individual flat frames in parallel.
+                # executor.map() returns the results in the same order as
+                # item_lst
+                filename_lst = [os.path.join(rawdata, logitem['fileid']+'.fits')
+                                for logitem in item_lst]
+                with concurrent.futures.ProcessPoolExecutor(
+                        max_workers = min(nflat, os.cpu_count() or 1),
+                        initializer = _init_flat_worker,
+                        initargs    = (bias, exptime_key),
+                        ) as executor:
+                    result_lst = executor.map(_prep_flat_frame, filename_lst)
+
+                    for i_item, (logitem, result) in enumerate(
+                            zip(item_lst, result_lst)):
+                        data, exptime, sat_mask, bad_mask, overmean = result
+                        exptime_lst.append(exptime)
+
+                        # generate the mask for all images
+                        if i_item == 0:
+                            # count of saturated frames for every pixel. a
+                            # uint8 counter is enough for less than 256 flats
+                            count_dtype = (np.int16, np.uint8)[nflat < 256]
+                            allmask = np.zeros_like(sat_mask,
+                                                    dtype=count_dtype)
+                        allmask += sat_mask
+
+                        if bias is None:
+                            message = 'No bias. skipped bias correction'
+                        else:
+                            message = 'Bias corrected'
+                        logger.info(message)
 
-                    # print info
-                    string = pinfo2.get_format().format(logitem, overmean)
-                    print(' '*2 + print_wrapper(string, logitem))
+                        # print info
+                        string = pinfo2.get_format().format(logitem, overmean)
+                        print(' '*2 + print_wrapper(string, logitem))
 
-                    data_lst.append(data)
+                        # write the corrected frame into the preallocated
+                        # datacube, instead of collecting the frames in a list
+                        # and copying them into a new array afterwards
+                        if i_item == 0:
+                            data_stack = np.empty((nflat,)+data.shape,
+                                                  dtype=data.dtype)
+                        data_stack[i_item] = data
 
                 print(' '*2 + pinfo2.get_separator())
 
                 if nflat == 1:
-                    flat_data = data_lst[0]
+                    flat_data = data_stack[0]
                 else:
-                    data_lst = np.array(data_lst)
-                    flat_data = combine_images(data_lst,
+                    flat_data = combine_images(data_stack,
                                     mode       = 'mean',
                                     upper_clip = 10,
                                     maxiter    = 5,
@@ -336,7 +432,7 @@ def reduce_doublefiber(logtable, config):
                             fits.ImageHDU(flat_sens),
                             fits.BinTableHDU(flat_spec)
                             ])
-                hdu_lst.writeto(flat_filename, overwrite=True)
+                _bulk_writeto(hdu_lst, flat_filename)
 
             '''
             # correct background for flat
@@ -471,7 +567,7 @@ def reduce_doublefiber(logtable, config):
                         fits.ImageHDU(flat_sens),
                         fits.BinTableHDU(flat_spec),
                         ])
-            hdu_lst.writeto(flat_fiber_file, overwrite=True)
+            _bulk_writeto(hdu_lst, flat_fiber_file)
 
         # align different fibers
         if ifiber == 0:
@@ -526,38 +622,44 @@ def reduce_doublefiber(logtable, config):
         fiber = chr(ifiber+65)
         aperset = master_aperset[fiber]
         for aper, aperloc in aperset.items():
-            x, y = aperloc.get_position()
             center = aperloc.get_center()
             all_aperloc_lst.append([fiber, aper, aperloc, center])
 
     # mosaic flat map
     sorted_aperloc_lst = sorted(all_aperloc_lst, key=lambda x:x[3])
     h, w = flat_data.shape
-    master_flatdata = np.ones_like(flat_data)
-    master_flatmask = np.ones_like(flat_mask)
-    master_flatnorm = np.ones_like(flat_norm)
-    master_flatsens = np.ones_like(flat_sens)
-    yy, xx = np.mgrid[:h, :w]
-    prev_line = np.zeros(w)
-    for i in np.arange(len(sorted_aperloc_lst)-1):
-        fiber, aper, aperloc, center = sorted_aperloc_lst[i]
-        x, y = aperloc.get_position()
-        next_fiber, _, next_aperloc, _ = sorted_aperloc_lst[i+1]
-        next_x, next_y = next_aperloc.get_position()
-        next_line = np.int32(np.round((y + next_y)/2.))
-        #print(fiber, aper, center, prev_line, next_line)
-        mask = (yy >= prev_line)*(yy < next_line)
+    # every pixel is assigned to one of the fibers below, so the master
+    # images need no initial values
+    master_flatdata = np.empty_like(flat_data)
+    master_flatmask = np.empty_like(flat_mask)
+    master_flatnorm = np.empty_like(flat_norm)
+    master_flatsens = np.empty_like(flat_sens)
+    # the image is divided into bands by the middle lines of adjacent
+    # apertures, and the i-th band belongs to the fiber of the i-th aperture.
+    # the band index of every pixel is the number of middle lines above or at
+    # it, which is counted by a cumulative sum along the y axis
+    cols = np.arange(w)
+    # evaluate the positions of all apertures of every fiber at once
+    position_lst = {fiber: aperset.get_positions(cols)
+                    for fiber, aperset in master_aperset.items()}
+    positions = np.array([position_lst[fiber][aper]
+                          for fiber, aper, _, _ in sorted_aperloc_lst])
+    midlines = np.int32(np.round((positions[:-1] + positions[1:])/2.))
+    # lines outside the image are counted in the first or the last row
+    index = np.clip(midlines, 0, h)*w + cols
+    band_map = np.bincount(index.ravel(), minlength=(h+1)*w).reshape(h+1, w)
+    band_map = np.cumsum(band_map[0:h], axis=0)
+    fiber_idx = np.array([ord(item[0])-65 for item in sorted_aperloc_lst])
+    fiber_map = fiber_idx[band_map]
+
+    # copy the pixels of every fiber at once
+    for ifiber in range(n_fiber):
+        fiber = chr(ifiber+65)
+        mask = fiber_map == ifiber
         master_flatdata[mask] = flat_data_lst[fiber][mask]
         master_flatmask[mask] = flat_mask_lst[fiber][mask]
         master_flatnorm[mask] = flat_norm_lst[fiber][mask]
         master_flatsens[mask] = flat_sens_lst[fiber][mask]
-        prev_line = next_line
-    # parse the last order
-    mask = yy >= prev_line
-    master_flatdata[mask] = flat_data_lst[next_fiber][mask]
-    master_flatmask[mask] = flat_mask_lst[next_fiber][mask]
-    master_flatnorm[mask] = flat_norm_lst[next_fiber][mask]
-    master_flatsens[mask] = flat_sens_lst[next_fiber][mask]
 
     hdu_lst = fits.HDUList([
                 fits.PrimaryHDU(master_flatdata),
@@ -565,7 +667,7 @@ def reduce_doublefiber(logtable, config):
                 fits.ImageHDU(master_flatnorm),
                 fits.ImageHDU(master_flatsens),
                 ])
-    hdu_lst.writeto(flat_file, overwrite=True)
+    _bulk_writeto(hdu_lst, flat_file)
 
 
     ############################## Extract ThAr ################################
@@ -639,7 +741,7 @@ def reduce_doublefiber(logtable, config):
         if bias is None:
             message = 'No bias. skipped bias correction'
         else:
-            data = data - bias
+            np.subtract(data, bias, out=data)
             message = 'Bias corrected'
         logger.info(message)
 
@@ -857,7 +959,7 @@ def reduce_doublefiber(logtable, config):
                         ])
             fname = 'wlcalib.{}.{}.fits'.format(fileid, fiber)
             filename = os.path.join(midproc, fname)
-            hdu_lst.writeto(filename, overwrite=True)
+            _bulk_writeto(hdu_lst, filename)
 
             # pack to calib_lst
             if frameid not in calib_lst:
@@ -884,7 +986,7 @@ def reduce_doublefiber(logtable, config):
                     ])
         fname = '{}_{}.fits'.format(fileid, oned_suffix)
         filename = os.path.join(onedspec, fname)
-        hdu_lst.writeto(filename, overwrite=True)
+        _bulk_writeto(hdu_lst, filename)
 
     # print fitting summary
     fmt_string = (' [{:3d}] {}'
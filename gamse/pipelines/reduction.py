@@ -395,7 +395,11 @@ class Reduction(object):
             all_data = np.array(all_data)
             nz, ny, nx = all_data.shape
             #mask = (all_data == all_data.max(axis=0))
-            mask = (np.mgrid[:nz, :ny, :nx][0]==all_data.argmax(axis=0))
+            # mask the maximum value of every pixel by a scatter into a
+            # boolean cube, instead of comparing with a full index grid
+            mask = np.zeros((nz, ny, nx), dtype=bool)
+            np.put_along_axis(mask, all_data.argmax(axis=0)[np.newaxis],
+                              True, axis=0)
             maxiter = 10
             for nite in range(maxiter):
                 mdata = np.ma.masked_array(all_data, mask=mask)
@@ -283,8 +283,9 @@ def make_obslog(path):
         # determine the total number of saturated pixels
         saturation = (data>=65535).sum()
 
-        # find the 95% quantile
-        quantile95 = np.sort(data.flatten())[int(data.size*0.95)]
+        # find the 95% quantile. a partial sort is enough to get the element
+        i95 = int(data.size*0.95)
+        quantile95 = np.partition(data, i95, axis=None)[i95]
 
         item = [frameid, fileid, imgtype, objectname, i2cell, exptime, obsdate,
                 saturation, quantile95]
@@ -23,9 +23,8 @@ def get_edge_bin(array):
             >>> get_edge_bin(b)
             [(0, 1), (2, 4)]
     """
-    array1 = np.int64(array)
-    array1 = np.insert(array1, 0, 0)
-    array1 = np.append(array1, 0)
+    # pad one zero at both ends with a single copy
+    array1 = np.pad(np.int64(array), 1, mode='constant')
     tmp = array1 - np.roll(array1, 1)
     i1_lst = np.nonzero(tmp == 1)[0] - 1
     i2_lst = np.nonzero(tmp ==-1)[0] - 1
@@ -78,19 +77,55 @@ def get_local_minima(x, window=None):
             raise ValueError
 
         halfwin_lst = (window-1)//2
-        index_lst = []
-        for i in index:
-            halfwin = halfwin_lst[i]
-            i1 = max(0, i-halfwin)
-            i2 = min(i+halfwin+1, len(x))
-            if i == x[i1:i2].argmin() + i1:
-                index_lst.append(i)
+        halfwin = halfwin_lst[index]
+        i1 = np.maximum(0, index-halfwin)
+        i2 = np.minimum(index+halfwin+1, len(x))
+        # a candidate is kept if it is the first minimum in its window, i.e.
+        # it is smaller than all values on its left and not larger than all
+        # values on its right
+        keep = np.ones(index.size, dtype=bool)
+        m = index > i1
+        keep[m] = x[index[m]] < _get_range_min(x, i1[m], index[m])
+        m = i2 > index + 1
+        keep[m] &= x[index[m]] <= _get_range_min(x, index[m]+1, i2[m])
+        index_lst = index[keep]
         if len(index_lst)>0:
-            index_lst = np.array(index_lst)
             return index_lst, x[index_lst]
         else:
             return np.array([]), np.array([])
 
+def _get_range_min(x, i1, i2):
+    """Get the minimum values of a 1d array in a list of intervals.
+
+    A sparse table of the minimum values in intervals of 2\ :sup:`k`
+    elements is built, so that the minimum in any interval is found by
+    comparing two overlapping table entries.
+
+    Args:
+        x (:class:`numpy.ndarray`): A Numpy 1d array.
+        i1 (:class:`numpy.ndarray`): Starting indices of the intervals.
+        i2 (:class:`numpy.ndarray`): Ending indices (exclusive) of the
+            intervals. All intervals must be non-empty.
+
+    Returns:
+        :class:`numpy.ndarray`: Minimum values of **x** in the intervals.
+
+    """
+    result = np.empty(i1.size, dtype=x.dtype)
+    if i1.size == 0:
+        return result
+    length = i2 - i1
+    # level k of the table is the minimum of x[i:i+2**k]
+    k_lst = np.log2(length).astype(np.int64)
+    table = [x]
+    for k in range(1, k_lst.max()+1):
+        half = 2**(k-1)
+        table.append(np.minimum(table[-1][:-half], table[-1][half:]))
+    for k in np.unique(k_lst):
+        m = k_lst == k
+        result[m] = np.minimum(table[k][i1[m]], table[k][i2[m]-2**k])
+    return result
+
 def implete_none(lst):
     """Replace the None elemnets at the beginning and the end of list by auto
     increment integers.